@@ -1,30 +1,47 @@
+import time
+import argparse
 from models import *
 from utils import *
 
 
-def beam_test(model, config, idx2word, epoch):
+def beam_test(model, config, idx2word, epoch, evaluator=None, cache=None, greedy=False):
+    """
+    :param cache: loaded EncoderCache of the test set, the encoder is skipped
+    :param greedy: argmax decoding instead of beam search
+    """
     model.eval()
-    test_loader = data_load(config.filename_trimmed_test, config.batch_size, False)
-    result = []
-    for step, batch in enumerate(test_loader):
-        x, y = batch
+    test_loader = data_load(config.filename_trimmed_test, config.batch_size, False, num_workers=config.loader_workers)
+    position = [0]
 
-        # argmax
-        # _, idx = model.sample(x, y)
+    def decode(x, y):
+        encoded = None
+        if cache is not None:
+            encoded = cache.get(position[0], position[0] + x.size(0))
+        position[0] += x.size(0)
 
-        # beam batch
-        idx = model.beam_search(x)
-        for i in range(x.size(0)):
-            sen = index2sentence(list(idx[i]), idx2word)
-            result.append(' '.join(sen))
+        with torch.no_grad():
+            if greedy:
+                # argmax
+                _, idx = model.sample(x, y, encoded)
+            else:
+                # beam batch
+                idx = model.beam_search(x, encoded)
+        return idx
 
-        # write result
+    # summaries are written while decoding
+    filename_data = None
+    if config.write_summary:
         filename_data = config.filename_data + 'summary_' + str(epoch) + '.txt'
-    with open(filename_data, 'w', encoding='utf-8') as f:
-        f.write('\n'.join(result))
+    device = next(model.parameters()).device
+    result = run_pipeline(test_loader, decode, idx2word, filename_data, config.pipeline_queue, device)
 
     # rouge
-    score = rouge_score(config.filename_gold, filename_data)
+    if evaluator is None:
+        evaluator = RougeEvaluator(config.filename_gold, idx2word, config.rouge_workers)
+        score = evaluator.score(result)
+        evaluator.close()
+    else:
+        score = evaluator.score(result)
 
     # write rouge
     write_rouge(config.filename_rouge, score, epoch)
@@ -40,10 +57,100 @@ def beam_test(model, config, idx2word, epoch):
           ' p: %.4f' % score['rouge-l']['p'],
           ' r: %.4f' % score['rouge-l']['r'])
 
+    return score
+
+
+def speculative_test(model, draft, config, k):
+    """
+    greedy decoding of the test set with and without the draft model,
+    prints the acceptance rate, the speedup and the examples that differ
+    """
+    model.eval()
+    draft.eval()
+    test_loader = data_load(config.filename_trimmed_test, config.batch_size, False, num_workers=config.loader_workers)
+    greedy_time = 0
+    speculative_time = 0
+    rounds = 0
+    proposed = 0
+    accepted = 0
+    differ = 0
+    device = next(model.parameters()).device
+    for x, y in test_loader:
+        x = x.to(device)
+        y = y.to(device)
+        with torch.no_grad():
+            start = time.perf_counter()
+            _, idx = model.sample(x, y)
+            greedy_time += time.perf_counter() - start
+
+            start = time.perf_counter()
+            idx_s, s = model.speculative_sample(x, draft, k)
+            speculative_time += time.perf_counter() - start
+        differ += int((idx != idx_s).any(axis=1).sum())
+        rounds += s['rounds'] * x.size(0)
+        proposed += s['proposed']
+        accepted += s['accepted']
+
+    n = len(test_loader.dataset)
+    print('k: %d' % k, '|acceptance: %.4f' % (accepted / max(proposed, 1)),
+          '|tokens per round: %.2f' % (n * config.s_len / max(rounds, 1)))
+    print('greedy: %.2fs' % greedy_time, '|speculative: %.2fs' % speculative_time,
+          '|speedup: %.2fx' % (greedy_time / speculative_time))
+    print('summaries that differ from greedy: %d / %d' % (differ, n))
+
 
 if __name__ == '__main__':
     config = Config()
     vocab = Vocab(config)
-    filename = config.filename_model + 'model_13.pkl'
-    model = load_model(config, vocab.idx2word, filename)
-    beam_test(model, config, vocab.idx2word, 10)
\ No newline at end of file
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', type=str, default=config.filename_model + 'model_13.pkl', help="model file")
+    parser.add_argument('--epoch', '-e', type=int, default=10, help="epoch written to the ROUGE log")
+    parser.add_argument('--beam_size', type=int, default=0, help="0: config")
+    parser.add_argument('--s_len', '-s', type=int, default=0, help="summary length, 0: config")
+    parser.add_argument('--bf16', action='store_true', default=False, help="bfloat16 autocast")
+    parser.add_argument('--greedy', action='store_true', default=False, help="argmax decoding")
+    parser.add_argument('--draft', type=str, default='', help="draft model file, speculative greedy decoding")
+    parser.add_argument('--draft_hidden', type=int, default=256, help="draft model hidden size")
+    parser.add_argument('--draft_layers', type=int, default=1, help="draft model layers")
+    parser.add_argument('--k', type=int, default=4, help="the draft proposes k+1 tokens per round")
+    parser.add_argument('--cache', action='store_true', default=False,
+                        help="reuse encoder outputs cached for this model and test set")
+    args = parser.parse_args()
+
+    if args.beam_size:
+        config.beam_size = args.beam_size
+    if args.s_len:
+        config.s_len = args.s_len
+    if args.bf16:
+        config.bf16 = True
+    model = load_model(config, vocab.idx2word, args.model, inference=True)
+
+    cache = None
+    if args.cache:
+        cache = EncoderCache(config.filename_cache, args.model, config.filename_trimmed_test, config)
+        if not cache.exists():
+            loader = data_load(config.filename_trimmed_test, config.batch_size, False,
+                               num_workers=config.loader_workers)
+            cache.build(model, loader)
+        cache.load(next(model.parameters()).device)
+
+    if args.draft:
+        d_config = Config()
+        d_config.hidden_size = args.draft_hidden
+        d_config.n_layer = args.draft_layers
+        d_config.cnn = 0
+        d_config.rl = 0
+        d_config.s_len = config.s_len
+        draft = load_model(d_config, vocab.idx2word, args.draft, inference=True)
+        if torch.cuda.is_available():
+            model = model.cuda()
+            draft = draft.cuda()
+        speculative_test(model, draft, config, args.k)
+    elif config.module_profile:
+        profiler = ModuleProfiler(model).attach()
+        beam_test(model, config, vocab.idx2word, args.epoch, cache=cache, greedy=args.greedy)
+        profiler.detach()
+        profiler.report()
+    else:
+        beam_test(model, config, vocab.idx2word, args.epoch, cache=cache, greedy=args.greedy)
@@ -0,0 +1,384 @@
+import os
+import sys
+import copy
+import json
+import time
+import random
+import argparse
+import platform
+import subprocess
+import itertools
+import numpy as np
+import torch
+from utils import *
+from models import *
+
+
+# synthetic LCSTS shaped data, no dataset files needed
+def synthetic_corpus(n, seed=123, t_min=80, t_max=150, s_min=10, s_max=30):
+    rng = random.Random(seed)
+    chars = [chr(0x4e00 + i) for i in range(6000)]
+    # zipf-like character frequencies, as in Chinese news text
+    weights = [1.0 / (i + 1) for i in range(len(chars))]
+    text = [''.join(rng.choices(chars, weights, k=rng.randint(t_min, t_max))) for _ in range(n)]
+    summary = [''.join(rng.choices(chars, weights, k=rng.randint(s_min, s_max))) for _ in range(n)]
+    return text, summary
+
+
+def bench_config(args):
+    config = Config()
+    config.hidden_size = args.hidden_size
+    config.embedding_dim = args.hidden_size
+    config.t_len = args.t_len
+    config.s_len = args.s_len
+    config.batch_size = args.batch_size
+    return config
+
+
+def bench_preprocess(args, results):
+    config = bench_config(args)
+    text, summary = synthetic_corpus(args.n_examples)
+    word2idx = {w: i for i, w in enumerate(synthetic_idx2word(config))}
+
+    def run():
+        get_trimmed_datasets(text, word2idx, config.t_len)
+        get_trimmed_datasets(summary, word2idx, config.s_len)
+    r = timeit(run, args.repeat, 1)
+    r['examples_per_sec'] = args.n_examples / (r['p50_ms'] / 1000)
+    results['preprocess/n=%d' % args.n_examples] = r
+
+
+def bench_train(args, results):
+    for cnn, attn_flag, rl, cell in itertools.product(args.cnn, args.attn, args.rl, args.cell):
+        name = 'train/cnn=%d,attn=%s,rl=%d,cell=%s' % (cnn, attn_flag, rl, cell)
+        config = bench_config(args)
+        config.cnn = cnn
+        config.attn_flag = attn_flag
+        config.rl = rl
+        config.cell = cell
+        torch.manual_seed(123)
+        try:
+            model = build_model(config, synthetic_idx2word(config))
+            optim = torch.optim.Adam(model.parameters(), lr=config.LR)
+            model.train()
+            x, y = synthetic_batch(config)
+
+            def run():
+                loss, _ = model(x, y)
+                optim.zero_grad()
+                loss.backward()
+                optim.step()
+            r = timeit(run, args.repeat, args.warmup)
+            r['examples_per_sec'] = config.batch_size / (r['p50_ms'] / 1000)
+        except Exception as e:
+            r = {'error': '%s: %s' % (type(e).__name__, e)}
+        results[name] = r
+        print(name, r)
+
+
+def bench_sample(args, results):
+    config = bench_config(args)
+    torch.manual_seed(123)
+    model = build_model(config, synthetic_idx2word(config))
+    model.eval()
+    for batch_size in args.batch_sizes:
+        x, y = synthetic_batch(config, batch_size)
+
+        def run():
+            with torch.no_grad():
+                model.sample(x, y)
+        name = 'sample/batch=%d' % batch_size
+        results[name] = timeit(run, args.repeat, args.warmup)
+        print(name, results[name])
+
+
+def bench_beam(args, results):
+    config = bench_config(args)
+    torch.manual_seed(123)
+    model = build_model(config, synthetic_idx2word(config))
+    model.eval()
+    for beam_size, batch_size in itertools.product(args.beam_sizes, args.batch_sizes):
+        config.beam_size = beam_size
+        model.beam_size = beam_size
+        x, _ = synthetic_batch(config, batch_size)
+
+        def run():
+            with torch.no_grad():
+                model.beam_search(x)
+        name = 'beam/beam=%d,batch=%d' % (beam_size, batch_size)
+        results[name] = timeit(run, args.repeat, args.warmup)
+        print(name, results[name])
+
+
+def bench_detokenize(args, results):
+    config = bench_config(args)
+    idx2word = synthetic_idx2word(config)
+    rng = np.random.RandomState(123)
+    idx = rng.randint(4, config.vocab_size, (args.n_rows, config.s_len))
+    # <eos> somewhere in most rows, a few rows without one
+    stop = rng.randint(1, config.s_len + 10, args.n_rows)
+    for i in range(args.n_rows):
+        if stop[i] < config.s_len:
+            idx[i, stop[i]] = config.eos
+    detokenizer = Detokenizer(idx2word)
+    assert detokenizer(idx) == [index2sentence(list(row), idx2word) for row in idx]
+
+    def loop():
+        for row in idx:
+            ' '.join(index2sentence(list(row), idx2word))
+    for name, fn in (('index2sentence', loop), ('Detokenizer', lambda: detokenizer.join(idx))):
+        r = timeit(fn, args.repeat, 1)
+        r['rows_per_sec'] = args.n_rows / (r['p50_ms'] / 1000)
+        results['detokenize/%s,rows=%d' % (name, args.n_rows)] = r
+        print(name, r)
+
+
+def bench_fold(args, results):
+    config = bench_config(args)
+    for cnn in [c for c in args.cnn if c != 0]:
+        config.cnn = cnn
+        torch.manual_seed(123)
+        model = build_model(config, synthetic_idx2word(config))
+        # non-trivial running statistics
+        model.train()
+        with torch.no_grad():
+            for _ in range(3):
+                model.cnn(synthetic_batch(config)[0])
+        model.eval()
+        optimized = optimize_for_inference(copy.deepcopy(model))
+        for batch_size in args.batch_sizes:
+            x, _ = synthetic_batch(config, batch_size)
+            diff = max_difference(model, optimized, x)
+            for name, m in (('reference', model), ('folded', optimized)):
+                def run():
+                    with torch.no_grad():
+                        m.encode(x)
+                r = timeit(run, args.repeat, args.warmup)
+                r['max_abs_diff'] = diff
+                results['fold/cnn=%d,batch=%d,%s' % (cnn, batch_size, name)] = r
+                print('fold/cnn=%d,batch=%d,%s' % (cnn, batch_size, name), r)
+
+
+def bench_encoder(args, results):
+    config = bench_config(args)
+    for cnn, cell in itertools.product([c for c in args.cnn if c != 0], args.cell):
+        config.cnn = cnn
+        config.cell = cell
+        torch.manual_seed(123)
+        model = build_model(config, synthetic_idx2word(config))
+        model.eval()
+        for batch_size in args.batch_sizes:
+            x, _ = synthetic_batch(config, batch_size)
+            for parallel in (False, True):
+                config.parallel_encoder = parallel
+
+                def run():
+                    with torch.no_grad():
+                        model.encode(x)
+                name = 'encoder/cnn=%d,cell=%s,batch=%d,%s' % (cnn, cell, batch_size,
+                                                              'parallel' if parallel else 'serial')
+                results[name] = timeit(run, args.repeat, args.warmup)
+                print(name, results[name])
+        config.parallel_encoder = False
+
+
+def bench_padding(args, results):
+    # a sentence encoded alone and in a padded batch, dynamic_len masking has to make them agree
+    config = bench_config(args)
+    config.dynamic_len = True
+    for cnn, cell in itertools.product(args.cnn, args.cell):
+        config.cnn = cnn
+        config.cell = cell
+        torch.manual_seed(123)
+        model = build_model(config, synthetic_idx2word(config))
+        # non-trivial running statistics and bias, pad columns are not zero after a conv
+        if model.cnn is not None:
+            model.train()
+            with torch.no_grad():
+                for _ in range(3):
+                    model.cnn(synthetic_batch(config)[0])
+        x, _ = synthetic_batch(config, max(args.batch_sizes))
+        for i in range(x.size(0)):
+            x[i, torch.randint(1, config.t_len, ()):] = config.pad
+        name = 'padding/cnn=%d,cell=%s' % (cnn, cell)
+        try:
+            diff = padding_difference(model, x)
+            results[name] = {'max_abs_diff': diff, 'ok': diff < 1e-4}
+        except Exception as e:
+            results[name] = {'error': '%s: %s' % (type(e).__name__, e)}
+        print(name, results[name])
+
+
+def bench_bf16(args, results):
+    from memory_report import activation_bytes
+    config = bench_config(args)
+    torch.manual_seed(123)
+    model = build_model(config, synthetic_idx2word(config))
+    optim = torch.optim.Adam(model.parameters(), lr=config.LR)
+    x, y = synthetic_batch(config)
+    idx = {}
+    for bf16 in (False, True):
+        config.bf16 = bf16
+        precision = 'bf16' if bf16 else 'fp32'
+
+        model.train()
+        saved, _ = activation_bytes(model, x, y)
+        model.zero_grad()
+
+        def step():
+            loss, _ = model(x, y)
+            optim.zero_grad()
+            loss.backward()
+        r = timeit(step, args.repeat, args.warmup)
+        r['examples_per_sec'] = config.batch_size / (r['p50_ms'] / 1000)
+        r['activation_mb'] = saved / 2**20
+        results['bf16/train,%s' % precision] = r
+        print('bf16/train,%s' % precision, r)
+
+        model.eval()
+
+        def sample():
+            with torch.no_grad():
+                idx[precision] = model.sample(x, y)[1]
+        r = timeit(sample, args.repeat, args.warmup)
+        results['bf16/sample,%s' % precision] = r
+        print('bf16/sample,%s' % precision, r)
+    config.bf16 = False
+
+    # how far bf16 greedy summaries are from fp32 ones, ROUGE against the fp32 output
+    total = np.zeros((3, 3))
+    for a, b in zip(idx['bf16'], idx['fp32']):
+        total += sentence_scores(tuple(a.tolist()), tuple(b.tolist()))
+    total /= len(idx['fp32'])
+    agreement = {'rouge-1': float(total[0][0]), 'rouge-2': float(total[1][0]), 'rouge-l': float(total[2][0]),
+                 'token_agreement': float((idx['bf16'] == idx['fp32']).mean())}
+    results['bf16/agreement'] = agreement
+    print('bf16/agreement', agreement)
+
+
+def bench_self_critical(args, results):
+    # k sampled summaries + 1 greedy from one encoder pass, against k+1 passes that each encode
+    config = bench_config(args)
+    torch.manual_seed(123)
+    model = build_model(config, synthetic_idx2word(config))
+    model.train()
+    x, y = synthetic_batch(config)
+    for k in args.samples:
+        def batched():
+            loss = model.self_critical_loss(model.encode(x), y, k)
+            loss.backward()
+
+        def separate():
+            idx, log_prob = [], []
+            for i in range(k + 1):
+                s, p = model.rollout(model.encode(x), 1, greedy=i == k)
+                idx.append(s)
+                log_prob.append(p)
+            # same layout as one batched rollout
+            idx = torch.stack(idx, dim=1).view(-1, config.s_len)
+            log_prob = torch.stack(log_prob, dim=1)
+            rewards = torch.from_numpy(rouge_l_rewards(idx.numpy(), y.numpy(), config.eos, k + 1)).view(-1, k + 1)
+            loss = -((rewards[:, :k] - rewards[:, k:]) * log_prob[:, :k]).mean()
+            loss.backward()
+
+        for name, fn in (('batched', batched), ('separate', separate)):
+            r = timeit(fn, args.repeat, args.warmup)
+            r['sequences_per_sec'] = config.batch_size * (k + 1) / (r['p50_ms'] / 1000)
+            results['self_critical/k=%d,%s' % (k, name)] = r
+            print('self_critical/k=%d,%s' % (k, name), '|%.1f sequences/s' % r['sequences_per_sec'])
+
+
+SUITES = {
+    'detokenize': bench_detokenize,
+    'preprocess': bench_preprocess,
+    'train': bench_train,
+    'sample': bench_sample,
+    'beam': bench_beam,
+    'fold': bench_fold,
+    'encoder': bench_encoder,
+    'padding': bench_padding,
+    'bf16': bench_bf16,
+    'self_critical': bench_self_critical,
+}
+
+
+def meta(args):
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'time': time.time(),
+        'commit': commit,
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'threads': torch.get_num_threads(),
+        'machine': platform.machine(),
+        'args': vars(args),
+    }
+
+
+def compare(results, filename, threshold):
+    """
+    compare p50 with a previous run
+    :return: names of the benchmarks that got slower by more than threshold
+    """
+    with open(filename, 'r', encoding='utf-8') as f:
+        base = json.load(f)['results']
+    regressions = []
+    for name, r in results.items():
+        if name not in base or 'p50_ms' not in r or 'p50_ms' not in base[name]:
+            continue
+        ratio = r['p50_ms'] / base[name]['p50_ms']
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = 'REGRESSION'
+            regressions.append(name)
+        print('%-48s %10.2f ms -> %10.2f ms  %.2fx %s' % (name, base[name]['p50_ms'], r['p50_ms'], ratio, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--suite', nargs='+', default=list(SUITES), choices=list(SUITES), help='benchmarks to run')
+    parser.add_argument('--repeat', '-r', type=int, default=10, help='timed runs')
+    parser.add_argument('--warmup', type=int, default=2, help='untimed runs')
+    parser.add_argument('--threads', type=int, default=0, help='torch intra-op threads, 0: default')
+    parser.add_argument('--hidden_size', type=int, default=512)
+    parser.add_argument('--t_len', type=int, default=150)
+    parser.add_argument('--s_len', type=int, default=50)
+    parser.add_argument('--batch_size', '-b', type=int, default=32, help='train batch size')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 8, 32], help='decoding batch sizes')
+    parser.add_argument('--beam_sizes', type=int, nargs='+', default=[1, 5, 10])
+    parser.add_argument('--n_examples', type=int, default=10000, help='preprocessing examples')
+    parser.add_argument('--n_rows', type=int, default=10000, help='detokenized rows')
+    parser.add_argument('--cnn', type=int, nargs='+', default=[0, 1, 2])
+    parser.add_argument('--attn', nargs='+', default=['luong', 'bahdanau'])
+    parser.add_argument('--rl', type=int, nargs='+', default=[0, 2])
+    parser.add_argument('--cell', nargs='+', default=['lstm', 'gru'])
+    parser.add_argument('--samples', type=int, nargs='+', default=[1, 4, 8], help='self-critical samples per example')
+    parser.add_argument('--output', '-o', type=str, default='', help='result json, default result/bench/<time>.json')
+    parser.add_argument('--compare', type=str, default='', help='previous result json')
+    parser.add_argument('--threshold', type=float, default=0.1, help='slowdown flagged as regression')
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    results = {}
+    for suite in args.suite:
+        SUITES[suite](args, results)
+
+    filename = args.output or 'result/bench/bench_%d.json' % time.time()
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    with open(filename, 'w', encoding='utf-8') as f:
+        json.dump({'meta': meta(args), 'results': results}, f, indent=2)
+    print('benchmark save at ', filename)
+
+    if args.compare:
+        if compare(results, args.compare, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
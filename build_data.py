@@ -1,3 +1,4 @@
+import json
 import argparse
 from utils import *
 
@@ -8,17 +9,42 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--t_len', '-t', metavar='NUM', type=int, help='display max_length')
     parser.add_argument('--s_len', '-s', metavar='NUM', type=int, help='display summary_length')
+    parser.add_argument('--dedup', action='store_true', default=False,
+                        help='remove duplicate train examples and those overlapping valid/test')
+    parser.add_argument('--workers', type=int, default=None, help='dedup hashing processes, 0: in process, default: config')
+    parser.add_argument('--step_ms', type=float, default=0,
+                        help='train step time (benchmark.py --suite train), reports the epoch time saved')
 
     args = parser.parse_args()
     if args.t_len:
         config.t_len = args.t_len
     if args.s_len:
         config.s_len = args.s_len
+    if args.dedup:
+        config.dedup = True
+    if args.workers is not None:
+        config.dedup_workers = args.workers
 
     # get datasets(train, valid, test)
     print('Loading data ... ...')
     datasets = Datasets(config)
 
+    if config.dedup:
+        print('Removing duplicates ... ...')
+        deduplicator = Deduplicator(config.dedup_workers, threshold=config.dedup_threshold)
+        exact, near = deduplicator.duplicates(datasets.train_text)
+        overlap = deduplicator.overlap(datasets.train_text, datasets.valid_text + datasets.test_text)
+        deduplicator.close()
+        report = dedup_report(datasets.train_text, datasets.train_summary, exact, near, overlap,
+                              config.batch_size, args.step_ms)
+        keep = np.nonzero(~(exact | near | overlap))[0]
+        datasets.train_text = [datasets.train_text[i] for i in keep]
+        datasets.train_summary = [datasets.train_summary[i] for i in keep]
+        with open(config.filename_dedup_report, 'w') as f:
+            json.dump(report, f, indent=1)
+        for name, value in report.items():
+            print(name, value)
+
     # get vocab(idx2word, word2idx)
     print('Building vocab ... ...')
     vocab = Vocab(config, datasets.train_text)
@@ -0,0 +1,134 @@
+import os
+import time
+import argparse
+import torch
+import torch.utils.data as data_util
+from models import *
+from utils import *
+from beam_test import beam_test
+
+
+USAGE = '''
+    python distill.py --teacher result/model/model_13.pkl --decode --top_k 8
+    python distill.py --teacher result/model/model_13.pkl --train --epoch 10
+    python distill.py --teacher result/model/model_13.pkl --report
+
+--decode runs the teacher over the training set once and keeps its summaries
+(and top k next-token probabilities) memory mapped under --dirname, --train
+fits a student with fewer layers, a smaller hidden size and no cnn branch to
+them, --report compares teacher and student latency, size and ROUGE.
+'''
+
+
+def student_config(args):
+    config = Config()
+    config.hidden_size = args.hidden_size
+    config.n_layer = args.n_layer
+    config.cnn = 0
+    config.rl = 0
+    config.filename_model = args.dirname
+    config.filename_data = args.dirname
+    config.filename_rouge = os.path.join(args.dirname, 'ROUGE.txt')
+    return config
+
+
+def train_student(student, config, args):
+    optim = torch.optim.Adam(student.parameters(), lr=config.LR)
+    data = torch.load(config.filename_trimmed_train)
+    dataset = DistillDataset(data, args.dirname)
+    sampler = EpochSampler(len(dataset), True, args.seed)
+    train_loader = data_util.DataLoader(dataset, config.batch_size, sampler=sampler, num_workers=2)
+
+    for e in range(args.epoch):
+        student.train()
+        sampler.set_epoch(e, 0)
+        all_loss = 0
+        num = 0
+        for step, batch in enumerate(train_loader):
+            if torch.cuda.is_available():
+                batch = [b.cuda() for b in batch]
+            loss = distill_loss(student, batch, args.alpha)
+            optim.zero_grad()
+            loss.backward()
+            optim.step()
+
+            all_loss += loss.detach()
+            num += 1
+            if step % 200 == 0:
+                print('epoch:', e, '|step:', step, '|distill_loss: %.4f' % loss.item())
+        print('epoch:', e, '|distill_loss: %.4f' % (float(all_loss) / num))
+        save_model(student, os.path.join(args.dirname, 'student_' + str(e) + '.pkl'))
+    return student
+
+
+def report(teacher, student, config, s_config, idx2word, args):
+    rows = []
+    batch = synthetic_batch(config, args.batch_size)
+    for name, model, c in (('teacher', teacher, config), ('student', student, s_config)):
+        model.eval()
+        device = next(model.parameters()).device
+        x, y = [t.to(device) for t in batch]
+        with torch.no_grad():
+            greedy = timeit(lambda: model.sample(x, y), args.repeat, 1)
+            beam = timeit(lambda: model.beam_search(x), args.repeat, 1)
+        start = time.perf_counter()
+        score = beam_test(model, c, idx2word, name)
+        test_time = time.perf_counter() - start
+        rows.append((name, parameter_mb(model), greedy['p50_ms'], beam['p50_ms'], test_time,
+                     score['rouge-1']['f'], score['rouge-2']['f'], score['rouge-l']['f']))
+
+    print('%-8s %10s %10s %10s %10s %8s %8s %8s' % ('model', 'params MB', 'greedy ms', 'beam ms',
+                                                   'test s', 'R-1', 'R-2', 'R-L'))
+    for row in rows:
+        print('%-8s %10.1f %10.2f %10.2f %10.1f %8.4f %8.4f %8.4f' % row)
+
+
+if __name__ == '__main__':
+    config = Config()
+    vocab = Vocab(config)
+
+    parser = argparse.ArgumentParser(description='Knowledge distillation into a small student.', epilog=USAGE,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--teacher', type=str, default=config.filename_model + 'model_13.pkl', help="teacher model file")
+    parser.add_argument('--dirname', type=str, default='result/distill/',
+                        help="teacher outputs and student checkpoints")
+    parser.add_argument('--decode', action='store_true', default=False, help="decode the training set with the teacher")
+    parser.add_argument('--train', action='store_true', default=False, help="train the student")
+    parser.add_argument('--report', action='store_true', default=False, help="compare teacher and student")
+    parser.add_argument('--greedy', action='store_true', default=False, help="teacher argmax instead of beam search")
+    parser.add_argument('--top_k', type=int, default=0, help="teacher probabilities kept per step, 0: summaries only")
+    parser.add_argument('--alpha', type=float, default=0.5, help="weight of the top k soft targets")
+    parser.add_argument('--hidden_size', type=int, default=256, help="student hidden size")
+    parser.add_argument('--n_layer', type=int, default=1, help="student layers")
+    parser.add_argument('--epoch', '-e', type=int, default=10, help="student training epochs")
+    parser.add_argument('--student', type=str, default='', help="student model file for --report, '': last epoch")
+    parser.add_argument('--batch_size', '-b', type=int, default=0, help="0: config")
+    parser.add_argument('--repeat', type=int, default=20, help="timed batches per model")
+    parser.add_argument('-seed', '-s', type=int, default=123, help="Random seed")
+    args = parser.parse_args()
+
+    if args.batch_size:
+        config.batch_size = args.batch_size
+    args.batch_size = config.batch_size
+    torch.manual_seed(args.seed)
+    os.makedirs(args.dirname, exist_ok=True)
+
+    teacher = load_model(config, vocab.idx2word, args.teacher)
+    s_config = student_config(args)
+    s_config.batch_size = config.batch_size
+    student = build_model(s_config, vocab.idx2word)
+    if torch.cuda.is_available():
+        teacher = teacher.cuda()
+        student = student.cuda()
+
+    if args.decode:
+        train_loader = data_load(config.filename_trimmed_train, config.batch_size, False)
+        decode_teacher(teacher, train_loader, config, args.dirname, not args.greedy, args.top_k)
+    if args.train:
+        train_student(student, s_config, args)
+        save_bundle(os.path.join(args.dirname, 'student.bundle'), s_config, vocab.idx2word, student.cpu())
+    if args.report:
+        filename = args.student or os.path.join(args.dirname, 'student_' + str(args.epoch - 1) + '.pkl')
+        student = load_model(s_config, vocab.idx2word, filename, inference=True).cpu()
+        teacher = load_model(config, vocab.idx2word, args.teacher, inference=True)
+        report(teacher, student, config, s_config, vocab.idx2word, args)
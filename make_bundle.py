@@ -0,0 +1,57 @@
+import sys
+import time
+import argparse
+import subprocess
+from utils import *
+from models import *
+
+
+def import_report(modules='models, utils', top=15):
+    """
+    cumulative import time of the packages pulled in by `import <modules>`, from python -X importtime
+    """
+    out = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + modules],
+                         stderr=subprocess.PIPE, universal_newlines=True).stderr
+    rows = []
+    for line in out.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # top level imports have no indentation
+        if name.startswith(' ') and not name.startswith('  '):
+            rows.append((int(cumulative) / 1000, name.strip()))
+    rows.sort(reverse=True)
+    print('import %s: %.1f ms' % (modules, sum(r[0] for r in rows)))
+    for ms, name in rows[:top]:
+        print('%10.1f ms  %s' % (ms, name))
+
+
+def startup_report(config, filename_model, filename_bundle):
+    start = time.perf_counter()
+    vocab = Vocab(config)
+    t_vocab = time.perf_counter() - start
+    model = load_model(config, vocab.idx2word, filename_model, inference=True)
+    t_model = time.perf_counter() - start
+
+    start = time.perf_counter()
+    _, _, model = load_bundle(filename_bundle)
+    t_bundle = time.perf_counter() - start
+    print('vocab pickles: %.1f ms' % (1000 * t_vocab), '|+ load_model: %.1f ms' % (1000 * t_model))
+    print('bundle: %.1f ms' % (1000 * t_bundle), '(%.1fx)' % (t_model / t_bundle))
+
+
+if __name__ == '__main__':
+    config = Config()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', type=str, default=config.filename_model + 'model_13.pkl', help="model file")
+    parser.add_argument('--output', '-o', type=str, default=config.filename_model + 'model.bundle', help="bundle file")
+    parser.add_argument('--report', action='store_true', default=False, help="import and startup time report")
+    args = parser.parse_args()
+
+    vocab = Vocab(config)
+    model = load_model(config, vocab.idx2word, args.model)
+    save_bundle(args.output, config, vocab.idx2word, model)
+    if args.report:
+        import_report()
+        startup_report(config, args.model, args.output)
@@ -0,0 +1,69 @@
+import time
+import argparse
+import torch
+from utils import *
+from models import *
+
+
+def activation_bytes(model, x, y):
+    """
+    run one train step and count the bytes autograd keeps for backward
+    :return: saved activation bytes, seconds of forward+backward
+    """
+    params = set(p.data_ptr() for p in model.parameters())
+    seen = set()
+    total = [0]
+
+    def pack(t):
+        storage = t.untyped_storage()
+        ptr = storage.data_ptr()
+        if ptr not in params and ptr not in seen:
+            seen.add(ptr)
+            total[0] += storage.nbytes()
+        return t
+
+    start = time.time()
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        loss, _ = model(x, y)
+    loss.backward()
+    return total[0], time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', '-b', type=int, default=32, help='batch size')
+    parser.add_argument('--s_len', '-s', type=int, default=0, help='summary length, 0: config')
+    parser.add_argument('--segments', type=int, nargs='+', default=[0, 1, 5, 10, 25], help='segment sizes')
+    parser.add_argument('--repeat', '-r', type=int, default=3, help='timed steps per segment size')
+    args = parser.parse_args()
+
+    config = Config()
+    config.batch_size = args.batch_size
+    if args.s_len:
+        config.s_len = args.s_len
+    torch.manual_seed(123)
+    x, y = synthetic_batch(config)
+    model = build_model(config, synthetic_idx2word(config))
+    model.train()
+
+    base = None
+    for segment in args.segments:
+        config.checkpoint_segment = segment
+        times = []
+        for _ in range(args.repeat):
+            model.zero_grad()
+            saved, t = activation_bytes(model, x, y)
+            times.append(t)
+        t = sorted(times)[len(times) // 2]
+        if base is None:
+            base = (saved, t)
+        print('segment: %3d' % segment,
+              '|activation: %8.1f MB' % (saved / 2**20),
+              '(%.2fx)' % (base[0] / max(saved, 1)),
+              '|step: %.3f s' % t,
+              '|examples/s: %.1f' % (config.batch_size / t),
+              '(%.2fx)' % (base[1] / t))
+
+
+if __name__ == '__main__':
+    main()
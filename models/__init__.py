@@ -4,4 +4,10 @@ from models.seq2seq import *
 from models.save_load import *
 from models.rouge import *
 from models.beam import *
-from models.cnn import *
\ No newline at end of file
+from models.cnn import *
+from models.cache import *
+from models.pipeline import *
+from models.optimize import *
+from models.bundle import *
+from models.distill import *
+from models.prune import *
\ No newline at end of file
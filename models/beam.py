@@ -1,87 +1,72 @@
 import torch
-import math
 
 
 class Beam():
-    def __init__(self, config, h):
+    """
+    Beams of a batch of examples.
+    Hypotheses are kept as one back-pointer and one token tensor per step and a
+    (batch, beam_size) score tensor; sequences are rebuilt by backtracking at the end.
+    An example stops advancing once all its beams end with <eos>.
+    """
+    def __init__(self, config, batch_size, device=None):
         self.beam_size = config.beam_size
         self.bos = config.bos
         self.eos = config.eos
-        self.finish_flag = False
-        self.cell = config.cell
-        self.path = []
+        self.batch_size = batch_size
 
-        self.path.append([[config.bos], h, 0])
-        for _ in range(config.beam_size-1):
-            self.path.append([[config.bos], h, -9999])
+        # only the first beam is alive at the start
+        self.scores = torch.full((batch_size, self.beam_size), -9999.0, device=device)
+        self.scores[:, 0] = 0
+        self.node = torch.full((batch_size, self.beam_size), self.bos, dtype=torch.long, device=device)
+        self.offset = torch.arange(batch_size, device=device).unsqueeze(1) * self.beam_size
+        self.keep = torch.arange(self.beam_size, device=device).expand(batch_size, self.beam_size)
+        self.back = []
+        self.tokens = []
 
-    def finish(self):
-        for i in range(len(self.path)):
-            if self.path[i][0][-1] != self.eos:
-                return
-        self.finish_flag = True
+    def finished(self):
+        """
+        :return: (batch) whether all beams of an example end with <eos>
+        """
+        return (self.node == self.eos).all(dim=1)
 
-    # return the node of current node
+    # return the nodes of the current step
     def get_node(self):
-        a = []
-        for i in range(len(self.path)):
-            node = self.path[i][0][-1]
-            a.append(torch.tensor(node).type(torch.LongTensor))
-        return torch.stack(a)
+        """
+        :return: (batch*beam_size)
+        """
+        return self.node.view(-1)
 
-    # return the hidden state of current node
-    def get_h(self):
-        if self.cell == 'lstm':
-            a = []
-            b = []
-            for i in range(len(self.path)):
-                a.append(self.path[i][1][0])
-                b.append(self.path[i][1][1])
-            a = torch.stack(a)
-            b = torch.stack(b)
-            a = (a, b)
-        else:
-            a = []
-            for i in range(len(self.path)):
-                a.append(self.path[i][1])
-            a = torch.stack(a)
-        return a
+    def advance(self, log_probs):
+        """
+        :param log_probs: (batch, beam_size, vocab_size) log probability of the next token
+        :return: (batch*beam_size) row of the decoder state each new hypothesis continues from
+        """
+        vocab_size = log_probs.size(2)
+        done = self.finished().unsqueeze(1)
+        candidate = (self.scores.unsqueeze(2) + log_probs).view(self.batch_size, -1)
+        scores, index = candidate.topk(self.beam_size, dim=1)
+        back = torch.div(index, vocab_size, rounding_mode='floor')
+        node = index % vocab_size
 
-    def max_path(self, candidate):
-        pos = 0 # position of max
-        v = -999 # value of max
-        for i in range(len(candidate)):
-            if candidate[i][-1] > v:
-                v = candidate[i][-1]
-                pos = i
-        return pos
+        # finished examples keep their beams
+        self.scores = torch.where(done, self.scores, scores)
+        back = torch.where(done, self.keep, back)
+        self.node = torch.where(done, self.node, node)
+        self.back.append(back)
+        self.tokens.append(self.node)
+        return (back + self.offset).view(-1)
 
-    def sort_path(self, candidate):
-        # initialization path
-        self.path = []
-        for i in range(self.beam_size):
-            self.path.append(candidate.pop(self.max_path(candidate)))
-
-    def advance(self, h, data):
-        self.finish()
-        if self.finish_flag:
-            return
-        else:
-            candidate = []
-            for i in range(len(self.path)):
-                sorted, indices = torch.sort(data[i], descending=True)
-                pre_path = self.path[i][0]
-                pre_scorce = self.path[i][-1]
-                for k in range(self.beam_size):
-                    p = pre_path.copy()
-                    p.append(int(indices[k]))
-                    if sorted[k].item() == 0:
-                        scorce = -999 + pre_scorce
-                    # print(sorted[k])
-                    else:
-                        scorce = math.log(sorted[k]) + pre_scorce
-                    if self.cell == 'lstm':
-                        candidate.append([p, (h[0][:, i], h[1][:, i]), scorce])
-                    else:
-                        candidate.append([p, h[i], scorce])
-            self.sort_path(candidate)
+    def backtrack(self, n_best=1):
+        """
+        :return: path (batch, n_best, steps+1) starting with <bos>, best first
+                  scores (batch, n_best)
+        """
+        scores, order = self.scores.sort(dim=1, descending=True)
+        ptr = order[:, :n_best]
+        path = []
+        for t in reversed(range(len(self.tokens))):
+            path.append(self.tokens[t].gather(1, ptr))
+            ptr = self.back[t].gather(1, ptr)
+        path.append(torch.full_like(ptr, self.bos))
+        path = torch.stack(path[::-1], dim=2)
+        return path, scores[:, :n_best]
@@ -0,0 +1,89 @@
+import json
+import struct
+import numpy as np
+import torch
+from utils.config import config_from_dict
+from models.save_load import build_model
+from models.optimize import optimize_for_inference
+
+
+# inference bundle, config, vocab and weights in one memory-mappable file:
+#     b'S2SBNDL1' | header length (uint64) | json header | padding | tensor data
+# the header holds the config attributes, idx2word and for every tensor of the
+# state dict its dtype, shape and byte offset; tensors are 64-byte aligned
+MAGIC = b'S2SBNDL1'
+ALIGN = 64
+DTYPES = {
+    'float32': (torch.float32, np.float32),
+    'float16': (torch.float16, np.float16),
+    'int64': (torch.int64, np.int64),
+}
+
+
+def _align(n):
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+
+def save_bundle(filename, config, idx2word, model):
+    tensors = []
+    offset = 0
+    # the shared embedding appears under several names, it is stored once
+    written = {}
+    for name, t in model.state_dict().items():
+        dtype = str(t.dtype).replace('torch.', '')
+        if dtype not in DTYPES:
+            raise TypeError('{} has unsupported dtype {}'.format(name, dtype))
+        key = (t.data_ptr(), dtype, tuple(t.shape))
+        if key not in written:
+            written[key] = offset
+            offset = _align(offset + t.numel() * t.element_size())
+        tensors.append({'name': name, 'dtype': dtype, 'shape': list(t.shape), 'offset': written[key]})
+    header = json.dumps({'config': vars(config), 'idx2word': list(idx2word), 'tensors': tensors}).encode('utf-8')
+    start = _align(len(MAGIC) + 8 + len(header))
+    with open(filename, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        state = model.state_dict()
+        for info in tensors:
+            f.seek(start + info['offset'])
+            f.write(state[info['name']].detach().cpu().contiguous().numpy().tobytes())
+        f.truncate(start + offset)
+    print('bundle save at ', filename)
+
+
+def load_bundle(filename, inference=True):
+    """
+    The model is built on the meta device and its parameters are assigned
+    copy-on-write views of the mapped file, nothing is initialized or copied.
+    :return: config, idx2word, model
+    """
+    with open(filename, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{} is not an inference bundle'.format(filename))
+        n = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(n).decode('utf-8'))
+    start = _align(len(MAGIC) + 8 + n)
+
+    config = config_from_dict(header['config'])
+    idx2word = header['idx2word']
+    # the embedding weights are in the bundle
+    config.filename_trimmed_embedding = ''
+
+    data = np.memmap(filename, dtype=np.uint8, mode='c')
+    state = {}
+    for info in header['tensors']:
+        torch_dtype, np_dtype = DTYPES[info['dtype']]
+        count = int(np.prod(info['shape'])) if info['shape'] else 1
+        begin = start + info['offset']
+        array = data[begin:begin + count * np.dtype(np_dtype).itemsize].view(np_dtype).reshape(info['shape'])
+        state[info['name']] = torch.from_numpy(array)
+
+    with torch.device('meta'):
+        model = build_model(config, idx2word)
+    model.load_state_dict(state, assign=True)
+    if inference:
+        optimize_for_inference(model)
+    else:
+        model.eval()
+    return config, idx2word, model
@@ -0,0 +1,171 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+import torch
+import torch.nn as nn
+
+
+def file_hash(filename, chunk_size=2**20):
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+# config fields that change what model.encode returns for the same checkpoint and data
+ENCODER_FIELDS = ('cell', 'n_layer', 'hidden_size', 'embedding_dim', 'bidirectional', 'cnn',
+                  't_len', 'pad', 'dynamic_len', 'bf16', 'filename_trimmed_embedding')
+
+
+def config_hash(config, fields=ENCODER_FIELDS):
+    values = {name: getattr(config, name, None) for name in fields}
+    return hashlib.sha1(json.dumps(values, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class EncoderCache():
+    """
+    Encoder outputs, cnn outputs and initial decoder states of a dataset,
+    stored as memory-mapped .npy files in
+    dirname/<model hash>_<data hash>_<encoder config hash>/.
+    Rows follow the dataset order, so a loader without shuffle reads them
+    back with get(start, end).
+    """
+    def __init__(self, dirname, filename_model, filename_data, config):
+        key = file_hash(filename_model)[:16] + '_' + file_hash(filename_data)[:16] + '_' + config_hash(config)[:16]
+        self.dirname = os.path.join(dirname, key)
+        self.arrays = None
+        self.device = None
+
+    def exists(self):
+        return os.path.isfile(os.path.join(self.dirname, 'meta.json'))
+
+    def _filename(self, name):
+        return os.path.join(self.dirname, name + '.npy')
+
+    def build(self, model, data_loader):
+        os.makedirs(self.dirname, exist_ok=True)
+        n = len(data_loader.dataset)
+        arrays = {}
+        start = 0
+        model.eval()
+        device = next(model.parameters()).device
+        for step, batch in enumerate(data_loader):
+            x, _ = batch
+            x = x.to(device)
+            with torch.no_grad():
+                h, encoder_out, cnn_out, mask = model.encode(x)
+            # states are stored batch first, sources padded back to the loader's length
+            if isinstance(h, tuple):
+                values = {'h': h[0].transpose(0, 1), 'c': h[1].transpose(0, 1)}
+            else:
+                values = {'h': h.transpose(0, 1)}
+            pad = x.size(1) - encoder_out.size(1)
+            values['encoder_out'] = nn.functional.pad(encoder_out, (0, 0, 0, pad))
+            if cnn_out is not None:
+                values['cnn_out'] = nn.functional.pad(cnn_out, (0, 0, 0, pad))
+            if mask is not None:
+                values['mask'] = nn.functional.pad(mask, (0, pad))
+            for name, v in values.items():
+                v = v.float().cpu().numpy()
+                if name not in arrays:
+                    arrays[name] = np.lib.format.open_memmap(self._filename(name), mode='w+',
+                                                             dtype=np.float32, shape=(n,) + v.shape[1:])
+                arrays[name][start:start+v.shape[0]] = v
+            start += x.size(0)
+        for v in arrays.values():
+            v.flush()
+        # meta.json marks a complete cache
+        with open(os.path.join(self.dirname, 'meta.json'), 'w') as f:
+            json.dump({'n': n, 'arrays': sorted(arrays)}, f)
+        print('encoder cache save at ', self.dirname)
+
+    def load(self, device=None):
+        """
+        :param device: device of the decoding model, get returns its tensors there
+        """
+        self.device = device
+        with open(os.path.join(self.dirname, 'meta.json')) as f:
+            meta = json.load(f)
+        self.arrays = {name: np.load(self._filename(name), mmap_mode='r') for name in meta['arrays']}
+        print('load encoder cache from', self.dirname)
+
+    def get(self, start, end):
+        """
+        :return: (h, encoder_out, cnn_out, mask) of rows [start, end), as Seq2seq.encode returns them
+        """
+        def tensor(name):
+            v = torch.from_numpy(np.ascontiguousarray(self.arrays[name][start:end]))
+            if self.device is not None:
+                v = v.to(self.device)
+            return v
+        h = tensor('h').transpose(0, 1).contiguous()
+        if 'c' in self.arrays:
+            h = (h, tensor('c').transpose(0, 1).contiguous())
+        cnn_out = tensor('cnn_out') if 'cnn_out' in self.arrays else None
+        mask = tensor('mask') > 0 if 'mask' in self.arrays else None
+        return h, tensor('encoder_out'), cnn_out, mask
+
+
+class SummaryCache():
+    """
+    Bounded LRU cache of summaries keyed on the trimmed source ids.
+    Entries older than ttl seconds are dropped on lookup (ttl=0: never).
+    """
+    def __init__(self, max_size=10000, ttl=0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(ids):
+        """
+        :param ids: (t_len) source ids after get_trimmed_datasets
+        """
+        if torch.is_tensor(ids):
+            ids = ids.cpu().numpy()
+        return hashlib.sha1(np.asarray(ids, dtype=np.int64).tobytes()).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            item = self.data.get(key)
+            if item is not None and self.ttl > 0 and time.time() - item[1] > self.ttl:
+                del self.data[key]
+                item = None
+            if item is None:
+                self.misses += 1
+                return None
+            self.data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key, value):
+        with self.lock:
+            self.data[key] = (value, time.time())
+            self.data.move_to_end(key)
+            while len(self.data) > self.max_size:
+                self.data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self.data),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / total if total else 0.0,
+            }
@@ -56,18 +56,36 @@ class Encoder_cnn(nn.Module):
         # )
         # ##############################
 
-    def forward(self, x):
+    def forward(self, x, mask=None):
+        """
+        :param x: (batch, len) len <= t_len
+        :param mask: (batch, len) non-pad positions, None: all
+        :return: (n_layer, batch, hidden_size)
+        """
         # e(batch, t_len, hidden_size)
         e = self.embeds(x)
 
-        e = self.input(e).transpose(1, 2)
+        e = self.input(e)
+        if mask is not None:
+            e = e * mask.unsqueeze(2).type_as(e)
+        e = e.transpose(1, 2)
 
         # (batch, hidden_size, t_len)
+        # pad columns are zeroed after every conv, relu(bn(bias)) would leak into real positions
         out = self.conv1(e)
+        if mask is not None:
+            out = out * mask.unsqueeze(1).type_as(out)
         out = self.conv2(out)
+        if mask is not None:
+            out = out * mask.unsqueeze(1).type_as(out)
         out = self.conv3(out)
+        if mask is not None:
+            out = out * mask.unsqueeze(1).type_as(out)
 
-        out = out.view(x.size(0), -1)
+        # positions past len are zero, as masked ones are
+        if out.size(2) < self.t_len:
+            out = nn.functional.pad(out, (0, self.t_len - out.size(2)))
+        out = out.reshape(x.size(0), -1)
         out = self.linear_out(out).view(1, -1, self.hidden_size)
         out = out.repeat(self.n_layer, 1, 1)
 
@@ -114,16 +132,31 @@ class Encoder_pos(nn.Module):
             nn.GLU()
         )
 
-    def forward(self, x):
+    def forward(self, x, mask=None):
+        """
+        :param x: (batch, len)
+        :param mask: (batch, len) non-pad positions, None: all
+        :return: (batch, len, hidden_size)
+        """
         # e(batch, t_len, hidden_size)
         e = self.embeds(x)
 
-        e = self.input(e).transpose(1, 2)
+        e = self.input(e)
+        if mask is not None:
+            e = e * mask.unsqueeze(2).type_as(e)
+        e = e.transpose(1, 2)
 
         # (batch, t_len, hidden_size)
+        # pad columns are zeroed after every conv, relu(bn(bias)) would leak into real positions
         out = self.conv1(e)
+        if mask is not None:
+            out = out * mask.unsqueeze(1).type_as(out)
         out = self.conv2(out)
+        if mask is not None:
+            out = out * mask.unsqueeze(1).type_as(out)
         out = self.conv3(out)
+        if mask is not None:
+            out = out * mask.unsqueeze(1).type_as(out)
 
         # (batch, hidden_size, t_len)
         cnn_out = out.transpose(1, 2)
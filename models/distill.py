@@ -0,0 +1,116 @@
+import os
+import json
+import numpy as np
+import torch
+import torch.utils.data as data_util
+
+
+def teacher_rows(idx, config):
+    """
+    teacher summaries in the layout of the trimmed data: tokens, <eos>, <pad>...
+    :param idx: list of id rows, beam search rows start with <bos>
+    :return: (batch, s_len) int16
+    """
+    rows = np.full((len(idx), config.s_len), config.pad, dtype=np.int16)
+    for i, row in enumerate(idx):
+        row = [int(t) for t in row]
+        if row and row[0] == config.bos:
+            row = row[1:]
+        if config.eos in row:
+            row = row[:row.index(config.eos) + 1]
+        row = row[:config.s_len]
+        rows[i, :len(row)] = row
+    return rows
+
+
+def decode_teacher(model, data_loader, config, dirname, beam=True, top_k=0):
+    """
+    Decode a dataset once with the teacher and keep the result in dirname:
+    tokens.npy (n, s_len) int16 teacher summaries, and with top_k > 0
+    topk_ids.npy (n, s_len, k) int16 / topk_probs.npy (n, s_len, k) float16,
+    the teacher's top k next-token probabilities along its own summary.
+    """
+    os.makedirs(dirname, exist_ok=True)
+    n = len(data_loader.dataset)
+    tokens = np.lib.format.open_memmap(os.path.join(dirname, 'tokens.npy'), mode='w+',
+                                       dtype=np.int16, shape=(n, config.s_len))
+    if top_k:
+        topk_ids = np.lib.format.open_memmap(os.path.join(dirname, 'topk_ids.npy'), mode='w+',
+                                             dtype=np.int16, shape=(n, config.s_len, top_k))
+        topk_probs = np.lib.format.open_memmap(os.path.join(dirname, 'topk_probs.npy'), mode='w+',
+                                               dtype=np.float16, shape=(n, config.s_len, top_k))
+    model.eval()
+    start = 0
+    for step, (x, y) in enumerate(data_loader):
+        if torch.cuda.is_available():
+            x = x.cuda()
+            y = y.cuda()
+        with torch.no_grad():
+            if beam:
+                idx = model.beam_search(x)
+            else:
+                _, idx = model.sample(x, y)
+            rows = teacher_rows(idx, config)
+            end = start + x.size(0)
+            tokens[start:end] = rows
+            if top_k:
+                target = torch.from_numpy(rows.astype(np.int64)).to(x.device)
+                probs = torch.softmax(model.logits(x, target), dim=-1)
+                p, i = probs.topk(top_k, dim=-1)
+                topk_ids[start:end] = i.cpu().numpy().astype(np.int16)
+                topk_probs[start:end] = p.cpu().numpy().astype(np.float16)
+        start = end
+        if step % 200 == 0:
+            print('teacher decode: %d / %d' % (start, n))
+    tokens.flush()
+    if top_k:
+        topk_ids.flush()
+        topk_probs.flush()
+    with open(os.path.join(dirname, 'meta.json'), 'w') as f:
+        json.dump({'n': n, 'top_k': top_k, 'beam': beam}, f)
+    print('teacher outputs save at ', dirname)
+
+
+class DistillDataset(data_util.Dataset):
+    """
+    (x, teacher summary[, top k ids, top k probs]) rows, read from the memory mapped teacher outputs
+    """
+    def __init__(self, data, dirname):
+        self.data = data
+        with open(os.path.join(dirname, 'meta.json')) as f:
+            self.top_k = json.load(f)['top_k']
+        self.tokens = np.load(os.path.join(dirname, 'tokens.npy'), mmap_mode='r')
+        if self.top_k:
+            self.topk_ids = np.load(os.path.join(dirname, 'topk_ids.npy'), mmap_mode='r')
+            self.topk_probs = np.load(os.path.join(dirname, 'topk_probs.npy'), mmap_mode='r')
+        if len(self.tokens) != len(data):
+            raise ValueError('{} teacher outputs for {} examples'.format(len(self.tokens), len(data)))
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, i):
+        x = self.data[i][0]
+        y = torch.from_numpy(self.tokens[i].astype(np.int64))
+        if not self.top_k:
+            return x, y
+        ids = torch.from_numpy(self.topk_ids[i].astype(np.int64))
+        probs = torch.from_numpy(self.topk_probs[i].astype(np.float32))
+        return x, y, ids, probs
+
+
+def distill_loss(student, batch, alpha):
+    """
+    cross entropy on the teacher summary, plus alpha times the cross entropy
+    against the teacher's renormalized top k distribution when it is there
+    """
+    x, y = batch[0], batch[1]
+    logits = student.logits(x, y)
+    loss = student.loss_func(logits.reshape(-1, logits.size(-1)), y.reshape(-1))
+    if len(batch) == 4 and alpha > 0:
+        ids, probs = batch[2], batch[3]
+        probs = probs / probs.sum(-1, keepdim=True).clamp(min=1e-6)
+        log_probs = torch.log_softmax(logits, dim=-1).gather(-1, ids)
+        soft = -(probs * log_probs).sum(-1).mean()
+        loss = (1 - alpha) * loss + alpha * soft
+    return loss
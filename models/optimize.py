@@ -0,0 +1,99 @@
+import torch
+import torch.nn as nn
+
+
+def fold_conv_bn(conv, bn):
+    """
+    :return: Conv1d computing bn(conv(x)) with the running statistics of bn
+    """
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    folded = nn.Conv1d(conv.in_channels, conv.out_channels, conv.kernel_size, conv.stride,
+                       conv.padding, conv.dilation, conv.groups, bias=True)
+    folded = folded.to(conv.weight.device, conv.weight.dtype)
+    bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+    with torch.no_grad():
+        folded.weight.copy_(conv.weight * scale.view(-1, 1, 1))
+        folded.bias.copy_((bias - bn.running_mean) * scale + bn.bias)
+    return folded
+
+
+class EmbeddingProjection(nn.Module):
+    """
+    embeds followed by a Linear, precomputed as one (vocab_size, out_features) table
+    """
+    def __init__(self, embeds, linear):
+        super().__init__()
+        with torch.no_grad():
+            table = linear(embeds.embeds.weight)
+        self.table = nn.Embedding.from_pretrained(table)
+
+    def forward(self, x):
+        return self.table(x)
+
+
+def fold_cnn(cnn):
+    """
+    inference form of Encoder_cnn / Encoder_pos:
+    Conv1d -> BatchNorm1d blocks become one Conv1d, and the embedding lookup
+    followed by the GLU input projection becomes a lookup in a projected table
+    """
+    for name in ('conv1', 'conv2', 'conv3'):
+        block = getattr(cnn, name)
+        if isinstance(block[1], nn.BatchNorm1d):
+            block[0] = fold_conv_bn(block[0], block[1])
+            block[1] = nn.Identity()
+    if isinstance(cnn.input[0], nn.Linear):
+        cnn.embeds = EmbeddingProjection(cnn.embeds, cnn.input[0])
+        cnn.input = nn.Sequential(nn.GLU())
+    return cnn
+
+
+def optimize_for_inference(model):
+    """
+    fold the eval-mode BatchNorm and the input projection of the cnn encoder
+    the model can no longer be trained or saved as a checkpoint afterwards
+    """
+    model.eval()
+    if model.cnn is not None:
+        fold_cnn(model.cnn)
+    return model
+
+
+def max_difference(model, optimized, x):
+    """
+    :return: largest absolute difference between the encodings of the two models
+    """
+    model.eval()
+    optimized.eval()
+    with torch.no_grad():
+        a = model.encode(x)
+        b = optimized.encode(x)
+    diff = 0.0
+    for u, v in zip(a, b):
+        if isinstance(u, tuple):
+            for p, q in zip(u, v):
+                diff = max(diff, float((p - q).abs().max()))
+        elif u is not None and u.is_floating_point():
+            diff = max(diff, float((u - v).abs().max()))
+    return diff
+
+
+def padding_difference(model, x):
+    """
+    with dynamic_len, encode every sentence of x alone and in the padded batch
+    :param x: (batch, t_len) sources of different lengths, padded with config.pad
+    :return: largest absolute difference over the non-pad positions and the decoder state
+    """
+    model.eval()
+    diff = 0.0
+    with torch.no_grad():
+        h, encoder_out, cnn_out, mask = model.encode(x)
+        for i in range(x.size(0)):
+            h_i, encoder_out_i, cnn_out_i, mask_i = model.encode(x[i:i+1])
+            n = mask_i.size(1)
+            diff = max(diff, float((encoder_out[i, :n] - encoder_out_i[0]).abs().max()))
+            if cnn_out is not None:
+                diff = max(diff, float((cnn_out[i, :n] - cnn_out_i[0]).abs().max()))
+            for u, v in zip(h if isinstance(h, tuple) else (h,), h_i if isinstance(h_i, tuple) else (h_i,)):
+                diff = max(diff, float((u[:, i] - v[:, 0]).abs().max()))
+    return diff
@@ -0,0 +1,96 @@
+import queue
+import threading
+from utils.dict import Detokenizer
+
+
+# marks the end of a queue
+_END = object()
+
+
+def _put(q, item, stop):
+    # a bounded put that gives up once the pipeline is stopped
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            pass
+
+
+def run_pipeline(data_loader, decode, idx2word=None, filename=None, queue_size=4, device=None):
+    """
+    Decode a dataset with loading, model and output work overlapped:
+    a producer thread fetches batches and moves them to the device, the calling
+    thread runs decode, a consumer thread detokenizes and streams summaries to
+    filename. The threads are connected by bounded queues.
+    :param decode: fn(x, y) -> ids of the batch, (batch, len) array or list of rows
+    :param filename: summaries are written here, one per line, when given
+    :param device: device of the model, None: batches stay where the loader puts them
+    :return: list of id rows in dataset order
+    """
+    batches = queue.Queue(queue_size)
+    outputs = queue.Queue(queue_size)
+    stop = threading.Event()
+    errors = []
+    result = []
+
+    def produce():
+        try:
+            for x, y in data_loader:
+                if device is not None:
+                    x = x.to(device, non_blocking=True)
+                    y = y.to(device, non_blocking=True)
+                _put(batches, (x, y), stop)
+                if stop.is_set():
+                    return
+        except Exception as e:
+            errors.append(e)
+        finally:
+            _put(batches, _END, stop)
+
+    def consume():
+        f = None
+        first = True
+        try:
+            if filename:
+                f = open(filename, 'w', encoding='utf-8')
+                detokenizer = Detokenizer(idx2word)
+            while True:
+                idx = outputs.get()
+                if idx is _END:
+                    return
+                if errors:
+                    # keep draining so the model thread never blocks
+                    continue
+                result.extend(idx)
+                if f is not None:
+                    lines = detokenizer.join(idx)
+                    f.write(('' if first else '\n') + '\n'.join(lines))
+                    first = False
+        except Exception as e:
+            errors.append(e)
+            while outputs.get() is not _END:
+                pass
+        finally:
+            if f is not None:
+                f.close()
+
+    producer = threading.Thread(target=produce, daemon=True)
+    consumer = threading.Thread(target=consume, daemon=True)
+    producer.start()
+    consumer.start()
+    try:
+        while True:
+            batch = batches.get()
+            if batch is _END:
+                break
+            x, y = batch
+            outputs.put(decode(x, y))
+    finally:
+        stop.set()
+        outputs.put(_END)
+        consumer.join()
+        producer.join()
+    if errors:
+        raise errors[0]
+    return result
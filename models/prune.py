@@ -0,0 +1,172 @@
+import copy
+import json
+import torch
+from utils.config import config_from_dict
+from models.save_load import build_model
+
+
+def prune_layout(config):
+    """
+    Every pruned dimension of every tensor as segments of named unit spaces,
+    tensors that have to agree on a unit share its space: encoder forward
+    layer l and decoder layer l (initial state), both directions of the top
+    encoder layer (summed), attention keys and queries, and the cnn output
+    (gated with the encoder output).
+    :return: {state_dict key: {dim: [(space, size), ...]}}, space None is never pruned
+    """
+    if config.cell != 'lstm':
+        raise ValueError("pruning needs cell='lstm', got cell={!r}".format(config.cell))
+    if config.attn_flag != 'luong':
+        raise ValueError("pruning needs attn_flag='luong', got attn_flag={!r}".format(config.attn_flag))
+    if config.cnn not in (0, 2):
+        raise ValueError('pruning needs cnn=0 or cnn=2, got cnn={}'.format(config.cnn))
+    if config.intra_decoder:
+        raise ValueError('pruning needs intra_decoder=False, got intra_decoder=True')
+    H = config.hidden_size
+    L = config.n_layer
+    emb = [('embedding', config.embedding_dim)]
+    layout = {}
+
+    def gates(space):
+        return [(space, H)] * 4
+
+    def lstm(prefix, l, suffix, space, inp):
+        layout['%s.weight_ih_l%d%s' % (prefix, l, suffix)] = {0: gates(space), 1: inp}
+        layout['%s.weight_hh_l%d%s' % (prefix, l, suffix)] = {0: gates(space), 1: [(space, H)]}
+        layout['%s.bias_ih_l%d%s' % (prefix, l, suffix)] = {0: gates(space)}
+        layout['%s.bias_hh_l%d%s' % (prefix, l, suffix)] = {0: gates(space)}
+
+    def linear(prefix, out, inp):
+        layout[prefix + '.weight'] = {0: out, 1: inp}
+        layout[prefix + '.bias'] = {0: out}
+
+    def conv_bn(prefix, out, inp):
+        layout[prefix + '.0.weight'] = {0: out, 1: inp}
+        layout[prefix + '.0.bias'] = {0: out}
+        for name in ('weight', 'bias', 'running_mean', 'running_var'):
+            layout['%s.1.%s' % (prefix, name)] = {0: out}
+
+    # forward layer l is decoder layer l, the top layer of both directions is the encoder output
+    top = 'rnn%d' % (L - 1)
+
+    def reverse(l):
+        return top if l == L - 1 else 'rnn%d_reverse' % l
+
+    for l in range(L):
+        if l == 0:
+            inp = emb
+        elif config.bidirectional:
+            inp = [('rnn%d' % (l - 1), H), (reverse(l - 1), H)]
+        else:
+            inp = [('rnn%d' % (l - 1), H)]
+        lstm('encoder.rnn', l, '', 'rnn%d' % l, inp)
+        if config.bidirectional:
+            lstm('encoder.rnn', l, '_reverse', reverse(l), inp)
+        lstm('decoder.rnn', l, '', 'rnn%d' % l, emb if l == 0 else [('rnn%d' % (l - 1), H)])
+
+    linear('decoder.attention.linear_in.0', [('attention_in', H)], [(top, H)])
+    linear('decoder.attention.linear_in.2', [(top, H)], [('attention_in', H)])
+    linear('decoder.attention.linear_out.0', [('attention_hidden', H)], [(top, H), (top, H)])
+    linear('decoder.attention.linear_out.2', [('attention_out', H)], [('attention_hidden', H)])
+    linear('linear_out', [(None, config.vocab_size)], [('attention_out', H)])
+    linear('linear_cnn', [(top, H)], [(top, H), (top, H)])
+
+    if config.cnn == 2:
+        linear('decoder.linear_enc.0', [('gate_hidden', H)], [(top, H)])
+        linear('decoder.linear_enc.2', [('gate_out', H)], [('gate_hidden', H)])
+        linear('decoder.linear_h.0', [('gate_h_hidden', H)], [(top, H)])
+        linear('decoder.linear_h.2', [('gate_h_out', H)], [('gate_h_hidden', H)])
+        linear('cnn.input.0', [('glu', H), ('glu', H)], emb)
+        conv_bn('cnn.conv1', [('conv1', H)], [('glu', H)])
+        conv_bn('cnn.conv2', [('conv2', H)], [('conv1', H)])
+        conv_bn('cnn.conv3', [(top, H)], [('conv2', H)])
+    return layout
+
+
+def tensor_layout(layout, key, embedding_dim):
+    # the shared embedding shows up under every module holding it
+    if key.endswith('embeds.embeds.weight'):
+        return {1: [('embedding', embedding_dim)]}
+    return layout.get(key, {})
+
+
+def unit_scores(state, layout, embedding_dim):
+    """
+    L2 norm of the weights of every unit, summed over the tensors it appears in,
+    each tensor normalized by its mean unit norm so that no tensor dominates
+    :return: {space: (size,) scores}
+    """
+    scores = {}
+    for key, t in state.items():
+        for dim, segments in tensor_layout(layout, key, embedding_dim).items():
+            t = t.float()
+            offset = 0
+            for space, size in segments:
+                if space is not None:
+                    part = t.narrow(dim, offset, size).transpose(0, dim).reshape(size, -1)
+                    norm = part.norm(dim=1)
+                    norm = norm / norm.mean().clamp(min=1e-12)
+                    scores[space] = scores.get(space, 0) + norm.cpu()
+                offset += size
+    return scores
+
+
+def segment_index(segments, keep):
+    index = []
+    offset = 0
+    for space, size in segments:
+        index.append(offset + (torch.arange(size) if space is None else keep[space]))
+        offset += size
+    return torch.cat(index)
+
+
+def prune_config(config, sparsity):
+    p_config = copy.copy(config)
+    p_config.hidden_size = max(int(round(config.hidden_size * (1 - sparsity))), 1)
+    if config.cnn == 2:
+        # the cnn takes the embeddings as hidden_size inputs
+        p_config.embedding_dim = p_config.hidden_size
+    # the pruned embedding is in the checkpoint
+    p_config.filename_trimmed_embedding = ''
+    return p_config
+
+
+def prune_model(model, config, idx2word, sparsity):
+    """
+    remove the lowest scoring sparsity fraction of the units of every space
+    :return: pruned config, dense model built by build_model(pruned config)
+    """
+    if config.cnn == 2 and config.embedding_dim != config.hidden_size:
+        raise ValueError('cnn=2 needs embedding_dim == hidden_size')
+    p_config = prune_config(config, sparsity)
+    state = {k: v.detach().cpu() for k, v in model.state_dict().items()}
+    layout = prune_layout(config)
+    scores = unit_scores(state, layout, config.embedding_dim)
+
+    keep = {}
+    for space, score in scores.items():
+        if space == 'embedding' and config.cnn != 2:
+            keep[space] = torch.arange(config.embedding_dim)
+            continue
+        # highest scores, in their original order
+        keep[space] = score.topk(p_config.hidden_size).indices.sort().values
+
+    pruned = {}
+    for key, t in state.items():
+        for dim, segments in tensor_layout(layout, key, config.embedding_dim).items():
+            t = t.index_select(dim, segment_index(segments, keep))
+        pruned[key] = t.clone()
+
+    p_model = build_model(p_config, idx2word)
+    p_model.load_state_dict(pruned)
+    return p_config, p_model
+
+
+def save_config(config, filename):
+    with open(filename, 'w') as f:
+        json.dump(vars(config), f, indent=1)
+
+
+def load_config(filename):
+    with open(filename) as f:
+        return config_from_dict(json.load(f))
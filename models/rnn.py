@@ -1,6 +1,7 @@
 import torch
 import torch.nn as nn
 from models import *
+from utils.data import load_embeddings
 
 
 class Embeds(nn.Module):
@@ -8,7 +9,10 @@ class Embeds(nn.Module):
         super().__init__()
         self.vocab_size = config.vocab_size
         self.embedding_dim = config.embedding_dim
-        if embedding:
+        if embedding is None and config.filename_trimmed_embedding:
+            embedding = load_embeddings(config.filename_trimmed_embedding)
+        if embedding is not None:
+            # frozen, the weight shares memory with the mapped file
             self.embeds = nn.Embedding.from_pretrained(embedding)
         else:
             self.embeds = nn.Embedding(self.vocab_size, self.embedding_dim)
@@ -50,16 +54,23 @@ class Encoder(nn.Module):
                 bidirectional=config.bidirectional
             )
 
-    def forward(self, x):
+    def forward(self, x, mask=None):
         """
         :param x:(batch, t_len)
+        :param mask:(batch, t_len) non-pad positions, the rnn stops at the last one; None: run over t_len
         :return: gru_h(n_layer, batch, hidden_size) lstm_h(h, c)
                   out(batch, t_len, hidden_size)
         """
         e = self.embeds(x)
         # out (batch, time_step, hidden_size*bidirection)
         # h (batch, n_layers*bidirection, hidden_size)
-        encoder_out, h = self.rnn(e)
+        if mask is not None:
+            lengths = mask.sum(1).clamp(min=1).cpu()
+            e = nn.utils.rnn.pack_padded_sequence(e, lengths, batch_first=True, enforce_sorted=False)
+            encoder_out, h = self.rnn(e)
+            encoder_out, _ = nn.utils.rnn.pad_packed_sequence(encoder_out, batch_first=True, total_length=x.size(1))
+        else:
+            encoder_out, h = self.rnn(e)
 
         if self.bidirectional:
             encoder_out = encoder_out[:, :, :self.hidden_size] + encoder_out[:, :, self.hidden_size:]
@@ -129,12 +140,13 @@ class Decoder(nn.Module):
             self.intra_attention = Luong_Attention(config)
             self.linear_intra = nn.Linear(config.hidden_size*2, config.hidden_size)
 
-    def forward(self, x, h, encoder_output, cnn_out, outs):
+    def forward(self, x, h, encoder_output, cnn_out, outs, mask=None):
         """
         :param x: (batch, 1) decoder input
         :param h: (batch, n_layer, hidden_size)
         :param encoder_output: (batch, t_len, hidden_size) encoder hidden state
         :param cnn_out: (batch, t_len, hidden_size)
+        :param mask: (batch, t_len) source positions that can be attended, None: all
         :return: attn_weight (batch, 1, time_step)
                   out (batch, 1, hidden_size) decoder output
                   h (batch, n_layer, hidden_size) decoder hidden state
@@ -143,9 +155,9 @@ class Decoder(nn.Module):
         e = self.embeds(x).unsqueeze(1) # (batch, 1, embedding_dim)
         if self.attn_flag == 'bahdanau':
             if self.cell == 'lstm':
-                attn_weights, e = self.attention(e, h[0], encoder_output)
+                attn_weights, e = self.attention(e, h[0], encoder_output, mask)
             else:
-                attn_weights, e = self.attention(e, h, encoder_output)
+                attn_weights, e = self.attention(e, h, encoder_output, mask)
         out, h = self.rnn(e, h)
         if self.rl:
             baseline = out
@@ -175,11 +187,56 @@ class Decoder(nn.Module):
             encoder_output = prob*encoder_output + (1-prob)*cnn_out
 
         if self.attn_flag == 'luong':
-            attn_weights, out = self.attention(out, encoder_output)
+            attn_weights, out = self.attention(out, encoder_output, mask)
         if self.attn_flag == 'multi':
-            attn_weights, out = self.attention(h[0].transpose(0, 1), encoder_output)
+            attn_weights, out = self.attention(h[0].transpose(0, 1), encoder_output, mask)
         if self.intra_decoder:
             attn_weights, c = self.intra_attention(out, outs)
             out = self.linear_intra(torch.cat((out, c), dim=-1))
 
-        return attn_weights, baseline, out, h
\ No newline at end of file
+        return attn_weights, baseline, out, h
+
+    def forward_steps(self, x, h, encoder_output, cnn_out, mask=None):
+        """
+        teacher forced decoding of k given tokens, the rnn steps one token at a time,
+        the cnn gate and luong attention run once on all steps
+        :param x: (batch, k) decoder inputs
+        :param h: decoder hidden state before x[:, 0]
+        :return: out (batch, k, hidden_size) decoder outputs
+                  states, decoder hidden state after each step
+        """
+        batch, k = x.size()
+        states = []
+        if self.attn_flag == 'bahdanau':
+            # the attention feeds the rnn input, step by step
+            outs = []
+            for i in range(k):
+                _, _, out, h = self.forward(x[:, i], h, encoder_output, cnn_out, None, mask)
+                outs.append(out)
+                states.append(h)
+            return torch.cat(outs, dim=1), states
+
+        e = self.embeds(x)
+        outs = []
+        for i in range(k):
+            out, h = self.rnn(e[:, i:i+1], h)
+            outs.append(out)
+            states.append(h)
+        # one row per step, (batch*k, 1, hidden_size)
+        out = torch.cat(outs, dim=1).reshape(batch*k, 1, -1)
+        if mask is not None:
+            mask = mask.repeat_interleave(k, dim=0)
+
+        # cnn prob, the top layer hidden state is the rnn output
+        if self.cnn == 2:
+            encoder = self.linear_enc(encoder_output).repeat_interleave(k, dim=0)
+            encoder_output = encoder_output.repeat_interleave(k, dim=0)
+            h_cnn = self.linear_enc(out.squeeze(1)).unsqueeze(2)
+            prob = self.sigmoid(torch.bmm(encoder, h_cnn))
+            encoder_output = prob*encoder_output + (1-prob)*cnn_out.repeat_interleave(k, dim=0)
+        else:
+            encoder_output = encoder_output.repeat_interleave(k, dim=0)
+
+        if self.attn_flag == 'luong':
+            _, out = self.attention(out, encoder_output, mask)
+        return out.view(batch, k, -1), states
\ No newline at end of file
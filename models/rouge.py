@@ -1,10 +1,11 @@
+import multiprocessing
 import numpy as np
-from utils.dict import index2sentence
-from rouge import FilesRouge
-from rouge import Rouge
+from utils.dict import Detokenizer
 
 
+# the rouge package is imported where it is used, decoding only processes never load it
 def rouge_score(filename_gold, filename_result):
+    from rouge import FilesRouge
     files_rouge = FilesRouge(filename_result, filename_gold)
     scores = files_rouge.get_scores(avg=True)
     return scores
@@ -34,19 +35,176 @@ def rouge_l(result, gold, idx2word):
     :param gold: (batch, len)
     :return: Rouge-L
     """
+    from rouge import Rouge
     scores = 0
     rouge = Rouge()
-    result = result.cpu()
-    gold = gold.cpu()
-    result = np.array(result)
-    gold = np.array(gold)
-    for i in range(result.shape[0]):
-        hyp = index2sentence(list(result[i]), idx2word)
-        hyp = ' '.join(hyp)
-        ref = index2sentence(list(gold[i]), idx2word)
-        ref = ' '.join(ref)
-
+    detokenizer = Detokenizer(idx2word)
+    hyps = detokenizer.join(result)
+    refs = detokenizer.join(gold)
+    for hyp, ref in zip(hyps, refs):
         scores += rouge.get_scores(hyp, ref)[0]['rouge-l']['f']
 
     r_l = scores/result.shape[0]
-    return r_l
\ No newline at end of file
+    return r_l
+
+
+def rouge_l_rewards(result, gold, eos, n=1):
+    """
+    sentence ROUGE-L F of every row on token ids, cut at <eos>, without <pad>
+    :param result: (batch*n, len) rows i*n ... i*n+n-1 are summaries of example i
+    :param gold: (batch, len)
+    :return: (batch*n,) float32
+    """
+    def tokens(row):
+        row = [int(t) for t in row]
+        if eos in row:
+            row = row[:row.index(eos)]
+        return tuple(t for t in row if t != 0)
+
+    refs = [tokens(row) for row in gold]
+    rewards = np.zeros(len(result), dtype=np.float32)
+    for i, row in enumerate(result):
+        hyp = tokens(row)
+        ref = refs[i // n]
+        rewards[i] = f_p_r(lcs_length(hyp, ref), len(hyp), len(ref))[0]
+    return rewards
+
+
+def lcs_length(a, b):
+    # bit-parallel LCS (Hyyro, 2004), one big-int operation per token of a
+    masks = {}
+    for i, c in enumerate(b):
+        masks[c] = masks.get(c, 0) | (1 << i)
+    full = (1 << len(b)) - 1
+    v = full
+    for c in a:
+        u = v & masks.get(c, 0)
+        v = ((v + u) | (v - u)) & full
+    return len(b) - bin(v).count('1')
+
+
+def ngram_counts(tokens, n):
+    counts = {}
+    for i in range(len(tokens) - n + 1):
+        g = tokens[i:i+n]
+        counts[g] = counts.get(g, 0) + 1
+    return counts
+
+
+def f_p_r(overlap, n_hyp, n_ref):
+    if n_hyp == 0 or n_ref == 0 or overlap == 0:
+        return 0.0, 0.0, 0.0
+    p = overlap / n_hyp
+    r = overlap / n_ref
+    return 2 * p * r / (p + r), p, r
+
+
+def sentence_scores(hyp, ref):
+    """
+    :param hyp: tuple of token ids
+    :param ref: tuple of token ids
+    :return: [(f, p, r) of ROUGE-1, ROUGE-2, ROUGE-L]
+    """
+    scores = []
+    for n in (1, 2):
+        h = ngram_counts(hyp, n)
+        r = ngram_counts(ref, n)
+        overlap = sum(min(c, r[g]) for g, c in h.items() if g in r)
+        scores.append(f_p_r(overlap, max(len(hyp) - n + 1, 0), max(len(ref) - n + 1, 0)))
+    scores.append(f_p_r(lcs_length(hyp, ref), len(hyp), len(ref)))
+    return scores
+
+
+# references of the worker process, sent once by the pool initializer
+_refs = None
+
+
+def _init_worker(refs):
+    global _refs
+    _refs = refs
+
+
+def _score_chunk(chunk):
+    index, hyps = chunk
+    total = np.zeros((3, 3))
+    for i, hyp in zip(index, hyps):
+        total += sentence_scores(hyp, _refs[i])
+    return total
+
+
+class RougeEvaluator():
+    """
+    ROUGE-1/2/L on token ids, without writing and re-reading summary files.
+    The gold summaries are read and mapped to ids once. Gold tokens missing
+    from the vocab get their own negative ids, so they never match '<unk>'.
+    N-gram overlap uses clipped counts, ROUGE-L is the sentence-level LCS F1.
+    """
+    def __init__(self, filename_gold, idx2word, n_workers=0, chunk_size=256):
+        self.word2idx = {w: i for i, w in enumerate(idx2word)}
+        self.pad = self.word2idx['<pad>']
+        self.unk = self.word2idx['<unk>']
+        self.bos = self.word2idx['<bos>']
+        self.eos = self.word2idx['<eos>']
+        self.chunk_size = chunk_size
+        self.refs = self._load_gold(filename_gold)
+        self.pool = None
+        if n_workers > 0:
+            self.pool = multiprocessing.Pool(n_workers, _init_worker, (self.refs,))
+
+    def _load_gold(self, filename):
+        oov = {}
+        refs = []
+        with open(filename, 'r', encoding='utf-8') as f:
+            for line in f:
+                ref = []
+                for w in line.split():
+                    idx = self.word2idx.get(w)
+                    if idx is None:
+                        idx = oov.setdefault(w, -1 - len(oov))
+                    ref.append(idx)
+                refs.append(tuple(ref))
+        return refs
+
+    def hypothesis(self, index):
+        # same tokens as index2sentence: stop at <eos>, skip <bos>, '<unk>' when empty
+        hyp = []
+        for idx in index:
+            idx = int(idx)
+            if idx == self.eos:
+                break
+            if idx != self.bos:
+                hyp.append(idx)
+        if len(hyp) == 0:
+            hyp.append(self.unk)
+        return tuple(hyp)
+
+    def score(self, result, index=None):
+        """
+        :param result: (n, len) ids, array or list of rows, in gold order
+        :param index: gold summary of each row, None: all gold summaries
+        :return: {'rouge-1': {'f', 'p', 'r'}, 'rouge-2': ..., 'rouge-l': ...} averaged over examples
+        """
+        if index is None:
+            index = range(len(self.refs))
+        if len(result) != len(index):
+            raise ValueError('{} summaries for {} gold summaries'.format(len(result), len(index)))
+        index = list(index)
+        hyps = [self.hypothesis(row) for row in result]
+        chunks = [(index[i:i+self.chunk_size], hyps[i:i+self.chunk_size])
+                  for i in range(0, len(hyps), self.chunk_size)]
+        if self.pool is not None:
+            total = sum(self.pool.map(_score_chunk, chunks))
+        else:
+            _init_worker(self.refs)
+            total = sum(_score_chunk(chunk) for chunk in chunks)
+        total = total / max(len(hyps), 1)
+        score = {}
+        for k, name in enumerate(('rouge-1', 'rouge-2', 'rouge-l')):
+            score[name] = {'f': float(total[k][0]), 'p': float(total[k][1]), 'r': float(total[k][2])}
+        return score
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
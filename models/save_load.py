@@ -1,7 +1,14 @@
+import os
+import copy
+import queue
+import random
+import threading
+import numpy as np
 from models.attention import *
 from models.rnn import *
 from models.seq2seq import *
 from models.cnn import *
+from models.optimize import optimize_for_inference
 
 
 def build_model(config, idx2word):
@@ -18,12 +25,141 @@ def build_model(config, idx2word):
     return model
 
 
-def load_model(config, idx2word, filename):
+def load_model(config, idx2word, filename, inference=False):
     model = build_model(config, idx2word)
     model.load_state_dict(torch.load(filename, map_location='cpu'))
+    # eval only model with the batchnorm folded into the convolutions
+    if inference:
+        optimize_for_inference(model)
     return model
 
 
 def save_model(model, filename):
     torch.save(model.state_dict(), filename)
-    print('model save at ', filename)
\ No newline at end of file
+    print('model save at ', filename)
+
+
+def snapshot(obj):
+    """copy every tensor in a (nested) state to cpu"""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: snapshot(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return copy.deepcopy(obj)
+
+
+def atomic_save(obj, filename):
+    # write to a temporary file and rename it, a crash never leaves a truncated checkpoint
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, filename)
+
+
+# plain tuples and tensors only, so that states load with weights_only=True
+def get_rng_state():
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    state = {
+        'python': random.getstate(),
+        'numpy': (name, torch.from_numpy(keys.astype(np.int64)), int(pos), int(has_gauss), float(cached_gaussian)),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    name, keys, pos, has_gauss, cached_gaussian = state['numpy']
+    np.random.set_state((name, keys.numpy().astype(np.uint32), pos, has_gauss, cached_gaussian))
+    torch.set_rng_state(state['torch'])
+    if torch.cuda.is_available() and 'cuda' in state:
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def state_filename(dirname, epoch, step):
+    return os.path.join(dirname, 'state_%04d_%08d.pt' % (epoch, step))
+
+
+# training states in dirname, oldest first
+def list_states(dirname):
+    if not os.path.isdir(dirname):
+        return []
+    names = sorted(n for n in os.listdir(dirname) if n.startswith('state_') and n.endswith('.pt'))
+    return [os.path.join(dirname, n) for n in names]
+
+
+def latest_state(dirname):
+    states = list_states(dirname)
+    if len(states) == 0:
+        return None
+    return states[-1]
+
+
+def load_state(filename):
+    print('load state from', filename)
+    return torch.load(filename, map_location='cpu', weights_only=True)
+
+
+class CheckpointWriter():
+    """
+    Write checkpoints from a background thread.
+    save() copies the state to cpu before returning, so training goes on
+    while the file is written. Only the last `keep` training states are kept.
+    """
+    def __init__(self, dirname, keep=3):
+        self.dirname = dirname
+        self.keep = keep
+        self.error = None
+        self.queue = queue.Queue(maxsize=2)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            obj, filename, rotate = item
+            try:
+                atomic_save(obj, filename)
+                print('checkpoint save at ', filename)
+                if rotate:
+                    self._prune()
+            except Exception as e:
+                self.error = e
+            self.queue.task_done()
+
+    def _prune(self):
+        states = list_states(self.dirname)
+        for filename in states[:max(len(states) - self.keep, 0)]:
+            os.remove(filename)
+
+    def _check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def save(self, obj, filename):
+        self._check()
+        self.queue.put((snapshot(obj), filename, False))
+
+    def save_state(self, state, epoch, step):
+        self._check()
+        self.queue.put((snapshot(state), state_filename(self.dirname, epoch, step), True))
+
+    # block until every queued checkpoint is on disk
+    def wait(self):
+        self.queue.join()
+        self._check()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self._check()
@@ -1,8 +1,36 @@
 import torch
 import torch.nn as nn
+import contextlib
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from torch.utils.checkpoint import checkpoint
 from models.beam import *
-from models.rouge import rouge_l
+from models.rouge import rouge_l, rouge_l_rewards
+from utils.monitor import stage, checkpoint_contexts
+
+
+# thread of the cnn encoder branch with parallel_encoder
+_branch_executor = None
+
+
+def branch_executor():
+    global _branch_executor
+    if _branch_executor is None:
+        _branch_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='cnn_branch')
+    return _branch_executor
+
+
+def select_state(states, index):
+    """
+    :param states: rnn hidden state after each step, (n_layer, batch, hidden_size) or lstm (h, c)
+    :param index: (batch,) step of every example
+    :return: hidden state of example i after step index[i]
+    """
+    if isinstance(states[0], tuple):
+        return tuple(select_state([s[j] for s in states], index) for j in range(len(states[0])))
+    rows = torch.arange(index.size(0), device=index.device)
+    # (steps, n_layer, batch, hidden_size) -> (batch, n_layer, hidden_size)
+    return torch.stack(states)[index, :, rows].transpose(0, 1).contiguous()
 
 
 class Seq2seq(nn.Module):
@@ -45,8 +73,14 @@ class Seq2seq(nn.Module):
         """
         return self.linear_out(x)
 
+    # bf16 compute with fp32 master weights (config.bf16), losses and beam scores stay in fp32
+    def autocast(self):
+        if not self.config.bf16:
+            return contextlib.nullcontext()
+        return torch.autocast('cuda' if torch.cuda.is_available() else 'cpu', dtype=torch.bfloat16)
+
     def compute_loss(self, result, y):
-        result = result.contiguous().view(-1, 4000)
+        result = result.float().contiguous().view(-1, 4000)
         y = y.contiguous().view(-1)
         loss = self.loss_func(result, y)
         return loss
@@ -57,10 +91,11 @@ class Seq2seq(nn.Module):
         r = torch.nn.functional.softmax(result, -1)
         r = torch.argmax(r, dim=-1)
 
-        scorce_b = rouge_l(b, y, self.idx2word)
-        scorce_f = rouge_l(r, y, self.idx2word)
+        with stage('reward'):
+            scorce_b = rouge_l(b, y, self.idx2word)
+            scorce_f = rouge_l(r, y, self.idx2word)
 
-        result = result.contiguous().view(-1, 4000)
+        result = result.float().contiguous().view(-1, 4000)
         y = y.contiguous().view(-1)
 
         loss_ml = self.loss_func(result, y)
@@ -68,181 +103,381 @@ class Seq2seq(nn.Module):
         loss = self.config.r*loss_lr+(1-self.config.r)*loss_ml
         return loss
 
-    def forward(self, x, y):
+    def encode(self, x):
         """
         :param x: (batch, t_len) encoder input
-        :param y: (batch, s_len) decoder input
-        :return:
+        :return: h initial decoder state, (n_layer, batch, hidden_size) or lstm (h, c)
+                  encoder_out (batch, len, hidden_size)
+                  cnn_out (batch, len, hidden_size) with cnn=2, else None
+                  mask (batch, len) non-pad positions with dynamic_len, else None
+        with dynamic_len the batch is cut to its longest source, len <= t_len
         """
-        h, encoder_out = self.encoder(x)
-        cnn_out = self.cnn(x)
+        mask = None
+        if self.config.dynamic_len:
+            mask = x != self.config.pad
+            x = x[:, :max(int(mask.sum(1).max()), 1)]
+            mask = mask[:, :x.size(1)]
+        cnn_out = None
+        if self.cnn is not None and self.config.parallel_encoder:
+            # the cnn branch runs on another thread while the rnn steps through time,
+            # grad mode and autocast are thread local and are carried over
+            grad = torch.is_grad_enabled()
+
+            def cnn_branch():
+                with torch.set_grad_enabled(grad), self.autocast(), stage('cnn'):
+                    return self.cnn(x, mask)
+            future = branch_executor().submit(cnn_branch)
+            with stage('encoder'):
+                h, encoder_out = self.encoder(x, mask)
+            cnn_out = future.result()
+        else:
+            with stage('encoder'):
+                h, encoder_out = self.encoder(x, mask)
+            if self.cnn is not None:
+                with stage('cnn'):
+                    cnn_out = self.cnn(x, mask)
 
         # connect
         if self.config.cnn == 1:
             hidden = self.linear_cnn(torch.cat((h[0], cnn_out), dim=-1))
             h = (hidden, h[1])
             cnn_out = None
+        return h, encoder_out, cnn_out, mask
 
-        # add <bos>
-        y_c = self.convert(y)
-
-        # decoder
+    def decode_segment(self, y_c, h, encoder_out, cnn_out, outs, mask, start):
+        """
+        teacher forced decoding of y_c[:, 0] ... y_c[:, -1], step start ... start+len
+        :param y_c: (batch, len) decoder input
+        :return: result (len, batch, vocab_size)
+                  baseline (len, batch, vocab_size) or None
+                  h, outs state after the last step
+        """
         result = []
         baseline = []
-        if self.config.intra_decoder:
-            if torch.cuda.is_available():
-                outs = torch.zeros(x.size(0), 1, self.config.hidden_size).type(torch.cuda.FloatTensor)
-            else:
-                outs = torch.zeros(x.size(0), 1, self.config.hidden_size)
-        else:
-            outs = None
-        for i in range(self.s_len):
-            _, b, out, h = self.decoder(y_c[:, i], h, encoder_out, cnn_out, outs)
+        for i in range(y_c.size(1)):
+            _, b, out, h = self.decoder(y_c[:, i], h, encoder_out, cnn_out, outs, mask)
             if self.config.intra_decoder:
-                if i == 0:
+                if start + i == 0:
                     outs = h[0].transpose(0, 1)[:, 1, :].unsqueeze(1)
                 else:
                     outs = torch.cat((outs, h[0].transpose(0, 1)[:, 1, :].unsqueeze(1)), dim=1)
             gen = self.output_layer(out).squeeze()
             result.append(gen)
-            if self.config.rl != 0:
+            if self.config.rl in (1, 2):
                 baseline.append(self.output_layer(b).squeeze())
+        result = torch.stack(result)
+        if self.config.rl in (1, 2):
+            baseline = torch.stack(baseline)
+        else:
+            baseline = None
+        return result, baseline, h, outs
+
+    def forward(self, x, y):
+        """
+        :param x: (batch, t_len) encoder input
+        :param y: (batch, s_len) decoder input
+        :return:
+        """
+        with self.autocast():
+            encoded = self.encode(x)
+            h, encoder_out, cnn_out, mask = encoded
 
-        outputs = torch.stack(result).transpose(0, 1)
+            # add <bos>
+            y_c = self.convert(y)
+
+            # decoder
+            if self.config.intra_decoder:
+                if torch.cuda.is_available():
+                    outs = torch.zeros(x.size(0), 1, self.config.hidden_size).type(torch.cuda.FloatTensor)
+                else:
+                    outs = torch.zeros(x.size(0), 1, self.config.hidden_size)
+            else:
+                outs = None
+            segment = self.config.checkpoint_segment
+            with stage('decoder'):
+                if segment > 0 and self.training and torch.is_grad_enabled():
+                    # recompute every segment of decoder steps in backward instead of keeping its activations
+                    result = []
+                    baseline = []
+                    for start in range(0, self.s_len, segment):
+                        gen, b, h, outs = checkpoint(self.decode_segment, y_c[:, start:start+segment], h,
+                                                     encoder_out, cnn_out, outs, mask, start, use_reentrant=False,
+                                                     context_fn=checkpoint_contexts)
+                        result.append(gen)
+                        baseline.append(b)
+                    result = torch.cat(result)
+                    if self.config.rl in (1, 2):
+                        baseline = torch.cat(baseline)
+                else:
+                    result, baseline, h, outs = self.decode_segment(y_c, h, encoder_out, cnn_out, outs, mask, 0)
+
+            outputs = result.transpose(0, 1)
 
         if self.config.rl == 0:
             loss = self.compute_loss(outputs, y)
+        elif self.config.rl == 3:
+            loss_ml = self.compute_loss(outputs, y)
+            with self.autocast():
+                loss_sc = self.self_critical_loss(encoded, y, self.config.rl_samples)
+            loss = self.config.r*loss_sc + (1-self.config.r)*loss_ml
         elif self.config.rl ==1:
             loss = self.compute_loss(outputs, y)
-            baseline = torch.stack(baseline).transpose(0, 1)
+            baseline = baseline.transpose(0, 1)
             loss_lr = self.rl_loss(baseline, outputs, y)
             loss = loss + loss_lr
         else:
             loss = self.compute_loss(outputs, y)
-            baseline = torch.stack(baseline).transpose(0, 1)
+            baseline = baseline.transpose(0, 1)
             loss_lr = self.rl_loss(baseline, outputs, y)
             loss = loss + loss_lr
         return loss, outputs
 
-    def sample(self, x, y):
-        h, encoder_out = self.encoder(x)
-        cnn_out = self.cnn(x)
-
-        if self.config.cnn == 1:
-            hidden = self.linear_cnn(torch.cat((h[0], cnn_out), dim=-1))
-            h = (hidden, h[1])
-            cnn_out = None
-
-        out = torch.ones(x.size(0)) * self.bos
-        result = []
-        idx = []
+    def rollout(self, encoded, n, greedy=True):
+        """
+        free running decoding of n summaries per example in one batch,
+        multinomial sampling, the last of the n argmax with greedy
+        :param encoded: encode(x)
+        :return: idx (batch*n, s_len), rows i*n ... i*n+n-1 belong to example i
+                  log_prob (batch*n,) summed over the tokens up to and including <eos>
+        """
+        h, encoder_out, cnn_out, mask = encoded
+        batch_size = encoder_out.size(0)
+        device = encoder_out.device
+        encoder_out = encoder_out.repeat_interleave(n, dim=0)
+        if cnn_out is not None:
+            cnn_out = cnn_out.repeat_interleave(n, dim=0)
+        if mask is not None:
+            mask = mask.repeat_interleave(n, dim=0)
+        if self.config.cell == 'lstm':
+            h = (h[0].repeat_interleave(n, dim=1), h[1].repeat_interleave(n, dim=1))
+        else:
+            h = h.repeat_interleave(n, dim=1)
         if self.config.intra_decoder:
-            if torch.cuda.is_available():
-                outs = torch.zeros(x.size(0), 1, self.config.hidden_size).type(torch.cuda.FloatTensor)
-            else:
-                outs = torch.zeros(x.size(0), 1, self.config.hidden_size)
+            outs = torch.zeros(batch_size*n, 1, self.config.hidden_size, device=device)
         else:
             outs = None
+
+        argmax = torch.zeros(batch_size, n, dtype=torch.bool, device=device)
+        if greedy:
+            argmax[:, -1] = True
+        argmax = argmax.view(-1)
+        out = torch.full((batch_size*n,), self.bos, dtype=torch.long, device=device)
+        alive = torch.ones(batch_size*n, dtype=torch.bool, device=device)
+        log_prob = torch.zeros(batch_size*n, device=device)
+        idx = []
         for i in range(self.s_len):
-            if torch.cuda.is_available():
-                out = out.type(torch.cuda.LongTensor)
-            else:
-                out = out.type(torch.LongTensor)
-            _, _, out, h = self.decoder(out, h, encoder_out, cnn_out, outs)
+            _, _, dec, h = self.decoder(out, h, encoder_out, cnn_out, outs, mask)
             if self.config.intra_decoder:
                 if i == 0:
                     outs = h[0].transpose(0, 1)[:, 1, :].unsqueeze(1)
                 else:
                     outs = torch.cat((outs, h[0].transpose(0, 1)[:, 1, :].unsqueeze(1)), dim=1)
-            gen = self.linear_out(out.squeeze(1))
-            result.append(gen)
-            gen = self.softmax(gen)
-            out = torch.argmax(gen, dim=1)
-            idx.append(out.cpu().numpy())
-        result = torch.stack(result).transpose(0, 1)
-        idx = np.transpose(np.array(idx))
+            # sampled in fp32
+            log_p = torch.log_softmax(self.linear_out(dec.squeeze(1)).float(), dim=-1)
+            sample = torch.multinomial(log_p.detach().exp(), 1).squeeze(1)
+            out = torch.where(argmax, log_p.detach().argmax(dim=-1), sample)
+            # finished summaries stop adding log probabilities
+            log_prob = log_prob + log_p.gather(1, out.unsqueeze(1)).squeeze(1) * alive
+            alive = alive & (out != self.config.eos)
+            idx.append(out)
+            if (i + 1) % 10 == 0 and not bool(alive.any()):
+                break
+        idx = torch.stack(idx, dim=1)
+        if idx.size(1) < self.s_len:
+            idx = torch.cat((idx, idx.new_full((idx.size(0), self.s_len - idx.size(1)), self.config.eos)), dim=1)
+        return idx, log_prob
+
+    def self_critical_loss(self, encoded, y, k):
+        """
+        self-critical policy gradient, k sampled summaries per example
+        rewarded by their ROUGE-L over the greedy summary of the same example
+        :param encoded: encode(x), shared by all k+1 summaries
+        """
+        with stage('decoder'):
+            idx, log_prob = self.rollout(encoded, k + 1)
+        with stage('reward'):
+            rewards = rouge_l_rewards(idx.cpu().numpy(), y.cpu().numpy(), self.config.eos, k + 1)
+        rewards = torch.from_numpy(rewards).to(log_prob.device).view(-1, k + 1)
+        advantage = rewards[:, :k] - rewards[:, k:]
+        log_prob = log_prob.view(-1, k + 1)[:, :k]
+        return -(advantage * log_prob).mean()
+
+    def logits(self, x, y):
+        """
+        teacher forced decoder outputs, without the loss
+        :param x: (batch, t_len) encoder input
+        :param y: (batch, s_len) target
+        :return: (batch, s_len, vocab_size) fp32
+        """
+        with self.autocast():
+            h, encoder_out, cnn_out, mask = self.encode(x)
+            if self.config.intra_decoder:
+                outs = torch.zeros(x.size(0), 1, self.config.hidden_size, device=encoder_out.device)
+            else:
+                outs = None
+            result, _, _, _ = self.decode_segment(self.convert(y), h, encoder_out, cnn_out, outs, mask, 0)
+        return result.transpose(0, 1).float()
+
+    def sample(self, x, y, encoded=None):
+        with self.autocast():
+            if encoded is None:
+                encoded = self.encode(x)
+            h, encoder_out, cnn_out, mask = encoded
+
+            out = torch.ones(x.size(0)) * self.bos
+            result = []
+            idx = []
+            if self.config.intra_decoder:
+                if torch.cuda.is_available():
+                    outs = torch.zeros(x.size(0), 1, self.config.hidden_size).type(torch.cuda.FloatTensor)
+                else:
+                    outs = torch.zeros(x.size(0), 1, self.config.hidden_size)
+            else:
+                outs = None
+            for i in range(self.s_len):
+                if torch.cuda.is_available():
+                    out = out.type(torch.cuda.LongTensor)
+                else:
+                    out = out.type(torch.LongTensor)
+                _, _, out, h = self.decoder(out, h, encoder_out, cnn_out, outs, mask)
+                if self.config.intra_decoder:
+                    if i == 0:
+                        outs = h[0].transpose(0, 1)[:, 1, :].unsqueeze(1)
+                    else:
+                        outs = torch.cat((outs, h[0].transpose(0, 1)[:, 1, :].unsqueeze(1)), dim=1)
+                gen = self.linear_out(out.squeeze(1))
+                result.append(gen)
+                gen = self.softmax(gen)
+                out = torch.argmax(gen, dim=1)
+                idx.append(out.cpu().numpy())
+            result = torch.stack(result).transpose(0, 1)
+            idx = np.transpose(np.array(idx))
         loss = self.compute_loss(result, y)
         return loss, idx
 
-    def beam_search(self, x):
-        h, encoder_out = self.encoder(x)
-        cnn_out = self.cnn(x)
+    def speculative_sample(self, x, draft, k=4):
+        """
+        The summaries of sample, decoded in rounds: the draft model proposes k+1 tokens
+        greedily, this model checks them in one teacher forced pass and keeps its own
+        argmax up to and including the first disagreement.
+        :param x: (batch, t_len) encoder input
+        :param draft: small Seq2seq with the same vocab
+        :return: idx (batch, s_len)
+                  stats {'rounds', 'proposed', 'accepted'}
+        """
+        if self.config.intra_decoder or draft.config.intra_decoder:
+            raise ValueError('speculative decoding does not support the intra decoder')
+        with self.autocast():
+            h, encoder_out, cnn_out, mask = self.encode(x)
+            d_h, d_encoder_out, d_cnn_out, d_mask = draft.encode(x)
+            batch_size = x.size(0)
+            device = encoder_out.device
 
-        if self.config.cnn == 1:
-            hidden = self.linear_cnn(torch.cat((h[0], cnn_out), dim=-1))
-            h = (hidden, h[1])
-            cnn_out = None
+            token = torch.full((batch_size,), self.bos, dtype=torch.long, device=device)
+            # room for the last round running past s_len
+            idx = torch.zeros(batch_size, self.s_len + k + 1, dtype=torch.long, device=device)
+            pos = torch.zeros(batch_size, dtype=torch.long, device=device)
+            offset = torch.arange(k + 1, device=device)
+            rounds = 0
+            proposed = torch.zeros((), dtype=torch.long, device=device)
+            accepted = torch.zeros((), dtype=torch.long, device=device)
+            while bool((pos < self.s_len).any()):
+                rounds += 1
+                active = (pos < self.s_len).long()
 
-        encoder_out = encoder_out.repeat(1, self.beam_size, 1).view(-1, self.config.t_len, self.config.hidden_size)
-        if cnn_out is not None:
-            cnn_out = cnn_out.repeat(1, self.beam_size, 1).view(-1, self.config.t_len, self.config.hidden_size)
+                # draft d_1 ... d_k+1
+                inputs = [token]
+                d_states = []
+                for i in range(k + 1):
+                    _, _, out, d_h = draft.decoder(inputs[-1], d_h, d_encoder_out, d_cnn_out, None, d_mask)
+                    inputs.append(torch.argmax(draft.linear_out(out.squeeze(1)), dim=-1))
+                    d_states.append(d_h)
+                # (batch, k+2) token, d_1 ... d_k+1
+                proposal = torch.stack(inputs, dim=1)
 
-        # initial beam
-        beam = []
-        for i in range(x.size(0)):
-            if self.config.cell == 'lstm':
-                beam.append(Beam(self.config, (h[0][:, i].squeeze(), h[1][:, i].squeeze())))
-            else:
-                beam.append(Beam(self.config, h[:, i].squeeze()))
+                # g_0 ... g_k after token, d_1 ... d_k
+                out, states = self.decoder.forward_steps(proposal[:, :-1], h, encoder_out, cnn_out, mask)
+                greedy = torch.argmax(self.softmax(self.linear_out(out)), dim=-1)
 
-        if self.config.intra_decoder:
-            outs = torch.zeros(x.size(0)*self.beam_size, 1, self.config.hidden_size)
-        else:
-            outs = None
+                # d_1 ... d_n agree with g_0 ... g_n-1, emit g_0 ... g_m-1
+                n = (greedy == proposal[:, 1:]).long().cumprod(dim=1).sum(dim=1)
+                m = torch.clamp(n + 1, max=k + 1) * active
+                col = (pos.unsqueeze(1) + offset).clamp(max=idx.size(1) - 1)
+                keep = offset.unsqueeze(0) < m.unsqueeze(1)
+                idx.scatter_(1, col, torch.where(keep, greedy, idx.gather(1, col)))
 
-        for i in range(self.s_len):
-            out = []
-            h = []
-            for i in range(x.size(0)):
-                out.append(beam[i].get_node())
-                h.append(beam[i].get_h())
-            out = torch.stack(out).view(-1) # (batch_size, beam_size, 1) -> (batch_size*beam_size)
-            # (batch_size, beam_size, n_layer, hidden_size) -> (batch_size*beam_size, n_layer, hidden_size)
-            # ->(n_layer, batch_size, hidden_size)
+                # both models continue from the state after their m-th input
+                last = (m - 1).clamp(min=0)
+                h = select_state(states, last)
+                d_h = select_state(d_states, last)
+                token = greedy.gather(1, last.unsqueeze(1)).squeeze(1)
+                pos = pos + m
+                proposed += (k + 1) * active.sum()
+                accepted += (n * active).sum()
+
+        stats = {'rounds': rounds, 'proposed': int(proposed), 'accepted': int(accepted)}
+        return idx[:, :self.s_len].cpu().numpy(), stats
+
+    def beam_search(self, x, encoded=None, n_best=0):
+        """
+        :param x: (batch, t_len) encoder input
+        :param n_best: 0: return the best summary of each example
+                       n: return the n best (summary, score) of each example
+        :return: list of id arrays starting with <bos>
+        """
+        with self.autocast():
+            if encoded is None:
+                encoded = self.encode(x)
+            h, encoder_out, cnn_out, mask = encoded
+            batch_size = x.size(0)
+
+            # (batch_size*beam_size, len, hidden_size), the beams of an example are adjacent
+            encoder_out = encoder_out.repeat_interleave(self.beam_size, dim=0)
+            if cnn_out is not None:
+                cnn_out = cnn_out.repeat_interleave(self.beam_size, dim=0)
+            if mask is not None:
+                mask = mask.repeat_interleave(self.beam_size, dim=0)
+            # (n_layer, batch_size*beam_size, hidden_size)
             if self.config.cell == 'lstm':
-                h0 = []
-                h1 = []
-                for i in range(len(h)):
-                    h0.append(h[i][0])
-                    h1.append(h[i][1])
-                h0 = torch.stack(h0).view(-1, self.config.n_layer, self.config.hidden_size).transpose(0, 1)
-                h1 = torch.stack(h1).view(-1, self.config.n_layer, self.config.hidden_size).transpose(0, 1)
-                h = (h0, h1)
+                h = (h[0].repeat_interleave(self.beam_size, dim=1), h[1].repeat_interleave(self.beam_size, dim=1))
             else:
-                h = torch.stack(h).view(-1, self.config.n_layer, self.hidden_size).transpose(0, 1)
-            if torch.cuda.is_available():
-                out = out.type(torch.cuda.LongTensor)
+                h = h.repeat_interleave(self.beam_size, dim=1)
+
+            beam = Beam(self.config, batch_size, encoder_out.device)
+            if self.config.intra_decoder:
+                outs = torch.zeros(batch_size*self.beam_size, 1, self.config.hidden_size, device=encoder_out.device)
             else:
-                out = out.type(torch.LongTensor)
+                outs = None
 
-            # out (batch_size*beam_size, 1, vocab_size)
-            # h (n_layer, batch_size*beam_size, hidden_size)
-            _, _, out, h = self.decoder(out, h, encoder_out, cnn_out, outs)
+            for i in range(self.s_len):
+                # out (batch_size*beam_size, 1, hidden_size)
+                # h (n_layer, batch_size*beam_size, hidden_size)
+                _, _, out, h = self.decoder(beam.get_node(), h, encoder_out, cnn_out, outs, mask)
 
-            if self.config.intra_decoder:
-                if i == 0:
-                    outs = h[0].transpose(0, 1)[:, 1, :].unsqueeze(1)
-                else:
-                    outs = torch.cat((outs, h[0].transpose(0, 1)[:, 1, :].unsqueeze(1)), dim=1)
+                if self.config.intra_decoder:
+                    if i == 0:
+                        outs = h[0].transpose(0, 1)[:, 1, :].unsqueeze(1)
+                    else:
+                        outs = torch.cat((outs, h[0].transpose(0, 1)[:, 1, :].unsqueeze(1)), dim=1)
 
-            out = self.linear_out(out)
-            out = self.softmax(out)
+                # (batch_size, beam_size, vocab_size), accumulated in fp32
+                out = self.linear_out(out.squeeze(1)).float()
+                out = torch.log_softmax(out, dim=-1).view(batch_size, self.beam_size, -1)
 
-            # out (batch_size, beam_size, vocab_size)
-            # h (n_layer, batch_size, beam_size, hidden_size)
-            out = out.view(-1, self.beam_size, self.config.vocab_size)
-            if self.config.cell == 'lstm':
-                h0 = h[0].view(self.config.n_layer, -1, self.beam_size, self.config.hidden_size)
-                h1 = h[1].view(self.config.n_layer, -1, self.beam_size, self.config.hidden_size)
-                h = (h0, h1)
-                for i in range(x.size(0)):
-                    beam[i].advance((h[0][:, i], h[1][:, i]), out[i])
-            else:
-                h = h.view(self.config.n_layer, -1, self.beam_size, self.config.hidden_size)
-                for i in range(x.size(0)):
-                    beam[i].advance(h[:, i], out[i])
-        idx = []
-        for i in range(x.size(0)):
-            # print(beam[i].path)
-            idx.append(np.array(beam[i].path[0][0]))
-        return idx
\ No newline at end of file
+                # continue every new hypothesis from the state of its parent
+                index = beam.advance(out)
+                if self.config.cell == 'lstm':
+                    h = (h[0].index_select(1, index), h[1].index_select(1, index))
+                else:
+                    h = h.index_select(1, index)
+                if outs is not None:
+                    outs = outs.index_select(0, index)
+                if bool(beam.finished().all()):
+                    break
+
+        path, scores = beam.backtrack(max(n_best, 1))
+        path = path.cpu().numpy()
+        if n_best == 0:
+            return [path[i][0] for i in range(batch_size)]
+        scores = scores.cpu().numpy()
+        return [[(path[i][k], float(scores[i][k])) for k in range(path.shape[1])] for i in range(batch_size)]
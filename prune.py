@@ -0,0 +1,81 @@
+import os
+import argparse
+import torch
+from models import *
+from utils import *
+from train import train
+from beam_test import beam_test
+
+
+USAGE = '''
+    python prune.py --model result/model/model_13.pkl --sparsity 0.25 0.5 0.75 --epoch 1
+
+For every sparsity the model is pruned to a dense model with a smaller
+hidden_size, fine-tuned with train.train for --epoch epochs and saved as
+<dirname>/sparsity_<s>/model.pkl next to its config.json:
+
+    config = load_config('result/prune/sparsity_0.5/config.json')
+    model = load_model(config, idx2word, 'result/prune/sparsity_0.5/model.pkl')
+'''
+
+
+def measure(model, config, idx2word, name, args):
+    model.eval()
+    device = next(model.parameters()).device
+    x, y = [t.to(device) for t in synthetic_batch(config, args.batch_size)]
+    with torch.no_grad():
+        greedy = timeit(lambda: model.sample(x, y), args.repeat, 1)
+        beam = timeit(lambda: model.beam_search(x), args.repeat, 1)
+    score = beam_test(model, config, idx2word, name)
+    return (name, config.hidden_size, parameter_mb(model), greedy['p50_ms'], beam['p50_ms'],
+            score['rouge-1']['f'], score['rouge-2']['f'], score['rouge-l']['f'])
+
+
+if __name__ == '__main__':
+    config = Config()
+    vocab = Vocab(config)
+
+    parser = argparse.ArgumentParser(description='Structured pruning, fine-tuning and the latency / ROUGE trade-off.',
+                                     epilog=USAGE, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', type=str, default=config.filename_model + 'model_13.pkl', help="model file")
+    parser.add_argument('--dirname', type=str, default='result/prune/', help="pruned models")
+    parser.add_argument('--sparsity', type=float, nargs='+', default=[0.25, 0.5, 0.75],
+                        help="fraction of the units removed")
+    parser.add_argument('--epoch', '-e', type=int, default=1, help="fine-tuning epochs, 0: none")
+    parser.add_argument('--batch_size', '-b', type=int, default=0, help="0: config")
+    parser.add_argument('--repeat', type=int, default=20, help="timed batches per model")
+    parser.add_argument('-seed', '-s', type=int, default=123, help="Random seed")
+    args = parser.parse_args()
+
+    if args.batch_size:
+        config.batch_size = args.batch_size
+    args.batch_size = config.batch_size
+    torch.manual_seed(args.seed)
+
+    model = load_model(config, vocab.idx2word, args.model)
+    rows = [measure(model, config, vocab.idx2word, 'dense', args)]
+    for sparsity in args.sparsity:
+        dirname = os.path.join(args.dirname, 'sparsity_%g/' % sparsity)
+        os.makedirs(dirname, exist_ok=True)
+        p_config, p_model = prune_model(model, config, vocab.idx2word, sparsity)
+        p_config.filename_model = dirname
+        p_config.filename_data = dirname
+        p_config.filename_rouge = os.path.join(dirname, 'ROUGE.txt')
+        save_config(p_config, os.path.join(dirname, 'config.json'))
+        print('sparsity:', sparsity, '|hidden_size:', p_config.hidden_size,
+              '|params MB: %.1f -> %.1f' % (parameter_mb(model), parameter_mb(p_model)))
+
+        if args.epoch:
+            if torch.cuda.is_available():
+                p_model = p_model.cuda()
+            train_args = argparse.Namespace(seed=args.seed, epoch=args.epoch, checkpoint=0,
+                                            resume=False, save_model=False)
+            train(p_model, train_args, p_config, vocab.idx2word)
+            p_model = p_model.cpu()
+        save_model(p_model, os.path.join(dirname, 'model.pkl'))
+        rows.append(measure(p_model, p_config, vocab.idx2word, 'sparsity_%g' % sparsity, args))
+
+    print('%-14s %8s %10s %10s %10s %8s %8s %8s' % ('model', 'hidden', 'params MB', 'greedy ms',
+                                                   'beam ms', 'R-1', 'R-2', 'R-L'))
+    for row in rows:
+        print('%-14s %8d %10.1f %10.2f %10.2f %8.4f %8.4f %8.4f' % row)
@@ -0,0 +1,211 @@
+import os
+import sys
+import time
+import multiprocessing
+import argparse
+import torch
+from utils import *
+from models import *
+
+
+def file_version(filenames):
+    version = []
+    for filename in filenames:
+        st = os.stat(filename)
+        version.append((filename, st.st_size, st.st_mtime_ns))
+    return tuple(version)
+
+
+class Summarizer():
+    """
+    Beam search summaries for raw texts, with an LRU cache in front of the model.
+    The model, the vocab and the cache are reloaded when the checkpoint or
+    a vocab file changes on disk, unless watch is False.
+    """
+    def __init__(self, config, filename_model, cache_size=10000, ttl=0, watch=True):
+        self.config = config
+        self.filename_model = filename_model
+        self.cache = SummaryCache(cache_size, ttl)
+        self.watch = watch
+        self.version = None
+        self._load()
+
+    def _check(self):
+        if self.watch:
+            self._load()
+
+    def _load(self):
+        bundle = self.filename_model.endswith('.bundle')
+        if bundle:
+            version = file_version([self.filename_model])
+        else:
+            version = file_version([self.filename_model, self.config.filename_word2idx, self.config.filename_idx2word])
+        if version == self.version:
+            return
+        if bundle:
+            # config, vocab and weights from one mapped file (make_bundle.py)
+            self.config, idx2word, self.model = load_bundle(self.filename_model)
+            self.vocab = Vocab.from_idx2word(self.config, idx2word)
+        else:
+            self.vocab = Vocab(self.config)
+            self.model = load_model(self.config, self.vocab.idx2word, self.filename_model, inference=True)
+        self.model.eval()
+        self.cache.clear()
+        self.version = version
+
+    def summarize(self, texts):
+        """
+        :param texts: list of source strings
+        :return: list of summaries, characters joined by ' '
+        """
+        self._check()
+        x = get_trimmed_datasets(texts, self.vocab.word2idx, self.config.t_len)
+        keys = [SummaryCache.key(row) for row in x]
+        result = [self.cache.get(k) for k in keys]
+        miss = [i for i in range(len(texts)) if result[i] is None]
+        for start in range(0, len(miss), self.config.batch_size):
+            index = miss[start:start+self.config.batch_size]
+            with torch.no_grad():
+                idx = self.model.beam_search(x[index])
+            for i, row in zip(index, idx):
+                result[i] = ' '.join(index2sentence(list(row), self.vocab.idx2word))
+                self.cache.put(keys[i], result[i])
+        return result
+
+
+def process_memory():
+    """
+    :return: rss, pss (shared pages divided among their users) and private MB of this process
+    """
+    memory = {}
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            fields = line.split()
+            if fields[0] in ('Rss:', 'Pss:', 'Private_Clean:', 'Private_Dirty:'):
+                memory[fields[0][:-1].lower()] = int(fields[1]) / 2**10
+    return {
+        'rss_mb': memory.get('rss', 0),
+        'pss_mb': memory.get('pss', 0),
+        'private_mb': memory.get('private_clean', 0) + memory.get('private_dirty', 0),
+    }
+
+
+def _serve(summarizer, threads, tasks, results):
+    torch.set_num_threads(threads)
+    while True:
+        job = tasks.get()
+        if job is None:
+            break
+        i, texts = job
+        results.put((i, summarizer.summarize(texts)))
+    results.put((None, process_memory()))
+
+
+def _serve_independent(config, filename_model, cache_size, ttl, threads, tasks, results):
+    # a worker with its own copy of the model, for comparison
+    torch.set_num_threads(threads)
+    _serve(Summarizer(config, filename_model, cache_size, ttl, watch=False), threads, tasks, results)
+
+
+class SummarizerPool():
+    """
+    Worker processes sharing one copy of the model.
+    The checkpoint and vocab are loaded once, the parameters are moved to
+    shared memory and the workers are forked, so they map the same pages.
+    Each worker runs `threads` intra-op threads.
+    With shared=False every worker loads its own model instead.
+    """
+    def __init__(self, config, filename_model, n_workers, threads=1, shared=True, cache_size=10000, ttl=0):
+        ctx = multiprocessing.get_context('fork')
+        self.tasks = ctx.Queue()
+        self.results = ctx.Queue()
+        self.n_workers = n_workers
+        self.workers = []
+        if shared:
+            # no intra-op thread pool may exist in the parent when it forks
+            parent_threads = torch.get_num_threads()
+            torch.set_num_threads(1)
+            summarizer = Summarizer(config, filename_model, cache_size, ttl, watch=False)
+            summarizer.model.share_memory()
+            for _ in range(n_workers):
+                self.workers.append(ctx.Process(target=_serve, args=(summarizer, threads, self.tasks, self.results)))
+        else:
+            for _ in range(n_workers):
+                self.workers.append(ctx.Process(target=_serve_independent,
+                                                args=(config, filename_model, cache_size, ttl, threads,
+                                                      self.tasks, self.results)))
+        for worker in self.workers:
+            worker.start()
+        if shared:
+            torch.set_num_threads(parent_threads)
+
+    def summarize(self, texts, chunk_size=8):
+        chunks = [texts[i:i+chunk_size] for i in range(0, len(texts), chunk_size)]
+        for i, chunk in enumerate(chunks):
+            self.tasks.put((i, chunk))
+        result = [None] * len(chunks)
+        for _ in chunks:
+            i, summaries = self.results.get()
+            result[i] = summaries
+        return [summary for chunk in result for summary in chunk]
+
+    def close(self):
+        """
+        :return: memory of every worker (process_memory)
+        """
+        for _ in self.workers:
+            self.tasks.put(None)
+        memory = [self.results.get()[1] for _ in self.workers]
+        for worker in self.workers:
+            worker.join()
+        return memory
+
+
+def pool_report(config, filename_model, texts, n_workers, threads):
+    for shared in (True, False):
+        pool = SummarizerPool(config, filename_model, n_workers, threads, shared, cache_size=0)
+        start = time.perf_counter()
+        pool.summarize(texts)
+        elapsed = time.perf_counter() - start
+        memory = pool.close()
+        print('shared' if shared else 'independent',
+              '|workers: %d' % n_workers,
+              '|texts/s: %.1f' % (len(texts) / elapsed),
+              '|rss MB/worker: %.1f' % (sum(m['rss_mb'] for m in memory) / n_workers),
+              '|pss MB/worker: %.1f' % (sum(m['pss_mb'] for m in memory) / n_workers),
+              '|private MB/worker: %.1f' % (sum(m['private_mb'] for m in memory) / n_workers))
+
+
+if __name__ == '__main__':
+    config = Config()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', type=str, default=config.filename_model + 'model_13.pkl',
+                        help="model file, or an inference bundle (.bundle)")
+    parser.add_argument('--cache_size', type=int, default=10000, help="cached summaries")
+    parser.add_argument('--ttl', type=float, default=0, help="seconds a summary stays cached, 0: no limit")
+    parser.add_argument('--workers', '-w', type=int, default=0, help="worker processes sharing the model, 0: none")
+    parser.add_argument('--threads', '-t', type=int, default=1, help="intra-op threads per worker")
+    parser.add_argument('--pool_report', type=str, default='',
+                        help="texts file, compare shared and independent workers on it")
+    args = parser.parse_args()
+
+    if args.pool_report:
+        with open(args.pool_report, 'r', encoding='utf-8') as f:
+            texts = [line.strip() for line in f]
+        pool_report(config, args.model, texts, max(args.workers, 1), args.threads)
+        sys.exit(0)
+
+    if args.workers:
+        pool = SummarizerPool(config, args.model, args.workers, args.threads, cache_size=args.cache_size, ttl=args.ttl)
+        texts = [line.strip() for line in sys.stdin]
+        for summary in pool.summarize(texts):
+            print(summary)
+        pool.close()
+        sys.exit(0)
+
+    summarizer = Summarizer(config, args.model, args.cache_size, args.ttl)
+    # one text per line on stdin, one summary per line on stdout
+    for line in sys.stdin:
+        print(summarizer.summarize([line.strip()])[0])
+    print(summarizer.cache.stats(), file=sys.stderr)
@@ -0,0 +1,215 @@
+import os
+import json
+import time
+import math
+import random
+import argparse
+import itertools
+import multiprocessing
+import torch
+from utils import *
+from models import *
+from train import valid, test
+from beam_test import beam_test
+
+
+SPEC_HELP = '''
+spec (json):
+    {
+        "grid": {"cell": ["lstm", "gru"], "cnn": [0, 1, 2]},
+        "random": {"hidden_size": [256, 512], "LR": {"min": 1e-4, "max": 1e-3, "log": true}},
+        "n_trials": 8,
+        "fixed": {"rl": 0, "s_len": 30}
+    }
+every combination of "grid" is a trial; with "random", n_trials samples are drawn
+for each grid point (lists: uniform choice, {"min", "max", "log"}: a range).
+'''
+
+
+def sample_value(rng, space):
+    if isinstance(space, dict):
+        if space.get('log'):
+            return math.exp(rng.uniform(math.log(space['min']), math.log(space['max'])))
+        value = rng.uniform(space['min'], space['max'])
+        if isinstance(space['min'], int) and isinstance(space['max'], int):
+            value = int(round(value))
+        return value
+    return rng.choice(space)
+
+
+def make_trials(spec, seed):
+    rng = random.Random(seed)
+    grid = spec.get('grid', {})
+    names = sorted(grid)
+    trials = []
+    for values in itertools.product(*[grid[n] for n in names]):
+        point = dict(zip(names, values))
+        if 'random' in spec:
+            for _ in range(spec.get('n_trials', 1)):
+                params = dict(point)
+                for name, space in sorted(spec['random'].items()):
+                    params[name] = sample_value(rng, space)
+                trials.append(params)
+        else:
+            trials.append(point)
+    for params in trials:
+        params.update(spec.get('fixed', {}))
+    return trials
+
+
+def trial_config(params, dirname):
+    config = Config()
+    for name, value in params.items():
+        if not hasattr(config, name):
+            raise AttributeError('Config has no attribute {}'.format(name))
+        setattr(config, name, value)
+    if 'hidden_size' in params and 'embedding_dim' not in params:
+        config.embedding_dim = config.hidden_size
+    # every trial logs to its own directory
+    os.makedirs(dirname, exist_ok=True)
+    config.filename_model = dirname
+    config.filename_data = dirname
+    config.filename_rouge = os.path.join(dirname, 'ROUGE.txt')
+    # trials run in daemonic pool workers, which cannot start processes
+    config.rouge_workers = 0
+    config.loader_workers = 0
+    return config
+
+
+# cores and threads of the worker process
+_worker = {}
+
+
+def _init_worker(slots, threads):
+    slot = slots.get()
+    cores = sorted(os.sched_getaffinity(0))
+    mine = cores[slot*threads:(slot+1)*threads] or cores
+    os.sched_setaffinity(0, mine)
+    torch.set_num_threads(len(mine))
+    _worker['slot'] = slot
+
+
+def should_stop(history, trial, epoch, loss, grace, min_trials):
+    """
+    median stopping rule: stop when the valid loss is worse than the median
+    of the other trials at the same epoch
+    """
+    if epoch < grace:
+        return False
+    others = [h[epoch] for t, h in history.items() if t != trial and len(h) > epoch]
+    if len(others) < min_trials:
+        return False
+    others.sort()
+    return loss > others[len(others) // 2]
+
+
+def run_trial(job):
+    trial, params, args, history = job
+    dirname = os.path.join(args.output, 'trial_%03d' % trial)
+    row = {'trial': trial, 'params': params, 'status': 'running', 'slot': _worker.get('slot')}
+    try:
+        config = trial_config(params, dirname)
+        torch.manual_seed(args.seed)
+        vocab = Vocab(config)
+        model = build_model(config, vocab.idx2word)
+        optim = torch.optim.Adam(model.parameters(), lr=config.LR)
+        train_loader = train_load(config.filename_trimmed_train, config.batch_size, args.seed, config.loader_workers)
+
+        losses = []
+        history[trial] = losses
+        examples = 0
+        train_time = 0
+        for e in range(args.epoch):
+            model.train()
+            train_loader.sampler.set_epoch(e)
+            start = time.perf_counter()
+            for step, (x, y) in enumerate(train_loader):
+                if args.max_steps and step >= args.max_steps:
+                    break
+                loss, _ = model(x, y)
+                optim.zero_grad()
+                loss.backward()
+                optim.step()
+                examples += x.size(0)
+            train_time += time.perf_counter() - start
+
+            loss_v = valid(model, e, config.filename_trimmed_valid, config, args.eval_subset)
+            losses.append(loss_v)
+            history[trial] = losses
+            row['epochs'] = e + 1
+            row['valid_loss'] = loss_v
+            if should_stop(dict(history), trial, e, loss_v, args.grace, args.min_trials):
+                row['status'] = 'stopped'
+                break
+
+        if args.beam:
+            score = beam_test(model, config, vocab.idx2word, row['epochs'])
+        else:
+            score, _ = test(model, row['epochs'], vocab.idx2word, config, None, args.eval_subset)
+        for name in ('rouge-1', 'rouge-2', 'rouge-l'):
+            row[name] = float(score[name]['f'])
+        row['examples_per_sec'] = examples / max(train_time, 1e-9)
+        if row['status'] == 'running':
+            row['status'] = 'done'
+    except Exception as e:
+        row['status'] = 'failed'
+        row['error'] = '%s: %s' % (type(e).__name__, e)
+    print('trial', trial, row, flush=True)
+    return row
+
+
+def print_table(rows):
+    names = sorted(set(k for r in rows for k in r['params']))
+    header = ['trial', 'status'] + names + ['epochs', 'valid_loss', 'rouge-1', 'rouge-2', 'rouge-l', 'examples/s']
+    print(' | '.join(header))
+    rows = sorted(rows, key=lambda r: r.get('rouge-l', -1), reverse=True)
+    for r in rows:
+        cells = [str(r['trial']), r['status']] + [str(r['params'].get(n, '')) for n in names]
+        for k in ('epochs', 'valid_loss', 'rouge-1', 'rouge-2', 'rouge-l', 'examples_per_sec'):
+            v = r.get(k, '')
+            cells.append('%.4f' % v if isinstance(v, float) else str(v))
+        print(' | '.join(cells))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Hyperparameter sweeps over Config attributes.', epilog=SPEC_HELP,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('spec', type=str, help='sweep spec json, see below')
+    parser.add_argument('--workers', '-w', type=int, default=2, help='trials run at once')
+    parser.add_argument('--threads', '-t', type=int, default=0, help='cores per trial, 0: split the machine')
+    parser.add_argument('--epoch', '-e', type=int, default=3, help='epochs per trial')
+    parser.add_argument('--max_steps', type=int, default=0, help='train steps per epoch, 0: all')
+    parser.add_argument('--eval_subset', type=int, default=1000, help='valid/test examples, 0: all')
+    parser.add_argument('--grace', type=int, default=1, help='epochs before a trial can be stopped')
+    parser.add_argument('--min_trials', type=int, default=3, help='trials compared before stopping one')
+    parser.add_argument('--beam', action='store_true', default=False, help='score ROUGE with beam search')
+    parser.add_argument('--seed', '-s', type=int, default=123)
+    parser.add_argument('--output', '-o', type=str, default='result/sweep/')
+    args = parser.parse_args()
+
+    with open(args.spec, 'r', encoding='utf-8') as f:
+        spec = json.load(f)
+    trials = make_trials(spec, args.seed)
+    print('%d trials on %d workers' % (len(trials), args.workers))
+
+    threads = args.threads or max(len(os.sched_getaffinity(0)) // args.workers, 1)
+    ctx = multiprocessing.get_context('spawn')
+    manager = ctx.Manager()
+    history = manager.dict()
+    slots = manager.Queue()
+    for slot in range(args.workers):
+        slots.put(slot)
+    with ctx.Pool(args.workers, _init_worker, (slots, threads)) as pool:
+        jobs = [(i, params, args, history) for i, params in enumerate(trials)]
+        rows = list(pool.imap_unordered(run_trial, jobs))
+
+    os.makedirs(args.output, exist_ok=True)
+    filename = os.path.join(args.output, 'results.json')
+    with open(filename, 'w', encoding='utf-8') as f:
+        json.dump(rows, f, indent=2)
+    print_table(rows)
+    print('sweep save at ', filename)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,7 @@
 import torch
 import numpy as np
 import pickle
+import multiprocessing
 import argparse
 from utils import *
 from models import *
@@ -13,10 +14,10 @@ def save_plot(train_loss, valid_loss, test_loss, test_rouge, filename_result):
         pickle.dump(result, f)
 
 
-def valid(model, epoch, filename, config):
+def valid(model, epoch, filename, config, subset=0):
     model.eval()
     # data
-    test_loader = data_load(filename, config.batch_size, False)
+    test_loader = data_load(filename, config.batch_size, False, subset, config.eval_seed, config.loader_workers)
     all_loss = 0
     num = 0
     for step, batch in enumerate(test_loader):
@@ -27,40 +28,40 @@ def valid(model, epoch, filename, config):
             y = y.cuda()
         with torch.no_grad():
             loss, _ = model.sample(x, y)
-        all_loss += loss.item()
+        all_loss += loss
+    all_loss = float(all_loss)
     print('epoch:', epoch, '|valid_loss: %.4f' % (all_loss / num))
     return all_loss / num
 
 
-def test(model, epoch, idx2word, config):
+def test(model, epoch, idx2word, config, evaluator=None, subset=0):
     model.eval()
     # data
-    test_loader = data_load(config.filename_trimmed_test, config.batch_size, False)
-    all_loss = 0
-    num = 0
-    result = []
-    for step, batch in enumerate(test_loader):
-        num += 1
-        x, y = batch
-        if torch.cuda.is_available():
-            x = x.cuda()
-            y = y.cuda()
+    test_loader = data_load(config.filename_trimmed_test, config.batch_size, False, subset, config.eval_seed,
+                            config.loader_workers)
+    index = getattr(test_loader.dataset, 'indices', None)
+    losses = []
+
+    def decode(x, y):
         with torch.no_grad():
             loss, idx = model.sample(x, y)
-        all_loss += loss.item()
-
-        for i in range(idx.shape[0]):
-            sen = index2sentence(list(idx[i]), idx2word)
-            result.append(' '.join(sen))
+        losses.append(loss)
+        return idx
+
+    # summaries are written while decoding
+    filename_data = None
+    if config.write_summary:
+        filename_data = config.filename_data + 'summary_' + str(epoch) + '.txt'
+    device = next(model.parameters()).device
+    result = run_pipeline(test_loader, decode, idx2word, filename_data, config.pipeline_queue, device)
+    num = len(losses)
+    all_loss = float(sum(losses))
     print('epoch:', epoch, '|test_loss: %.4f' % (all_loss / num))
 
-    # write result
-    filename_data = config.filename_data + 'summary_' + str(epoch) + '.txt'
-    with open(filename_data, 'w', encoding='utf-8') as f:
-        f.write('\n'.join(result))
-
     # rouge
-    score = rouge_score(config.filename_gold, filename_data)
+    if evaluator is None:
+        evaluator = RougeEvaluator(config.filename_gold, idx2word)
+    score = evaluator.score(result, index)
 
     # write rouge
     write_rouge(config.filename_rouge, score, epoch)
@@ -79,6 +80,21 @@ def test(model, epoch, idx2word, config):
     return score, all_loss / num
 
 
+def evaluate(model, epoch, idx2word, config, evaluator=None, subset=0):
+    loss_v = valid(model, epoch, config.filename_trimmed_valid, config, subset)
+    rouge, loss_t = test(model, epoch, idx2word, config, evaluator, subset)
+    return loss_v, rouge, loss_t
+
+
+# evaluate a saved model in a separate process, results go to the ROUGE log
+def evaluate_checkpoint(config, idx2word, filename, epoch, subset):
+    torch.set_num_threads(config.eval_threads)
+    model = load_model(config, idx2word, filename)
+    if torch.cuda.is_available():
+        model = model.cuda()
+    evaluate(model, epoch, idx2word, config, None, subset)
+
+
 def train(model, args, config, idx2word):
     # optim
     if config.optimzer == 'Adam':
@@ -87,7 +103,7 @@ def train(model, args, config, idx2word):
         optim = torch.optim.Adam(model.parameters(), lr=config.LR)
 
     # data
-    train_loader = data_load(config.filename_trimmed_train, config.batch_size, True)
+    train_loader = train_load(config.filename_trimmed_train, config.batch_size, args.seed, config.loader_workers)
 
     # loss result
     train_loss = []
@@ -95,45 +111,132 @@ def train(model, args, config, idx2word):
     test_loss = []
     test_rouge = []
 
+    writer = CheckpointWriter(config.filename_model, config.keep_checkpoint)
+    evaluator = RougeEvaluator(config.filename_gold, idx2word, config.rouge_workers)
+    eval_process = None
+    monitor = None
+    if config.filename_monitor:
+        monitor = Monitor(config.filename_monitor, config.monitor_every,
+                          config.profile_steps[0], config.profile_steps[1], config.filename_trace).enable()
+    profiler = None
+    if config.module_profile:
+        profiler = ModuleProfiler(model).attach()
+    start_epoch = args.checkpoint
+    start_step = 0
+    all_loss = 0
+    num = 0
+    rng = None
     if args.checkpoint != 0:
         model.load_state_dict(torch.load(config.filename_model + 'model_' + str(args.checkpoint) + '.pkl'))
-    for e in range(args.checkpoint, args.epoch):
+    if args.resume:
+        filename = latest_state(config.filename_model)
+        if filename is None:
+            raise FileNotFoundError('No training state in {}'.format(config.filename_model))
+        state = load_state(filename)
+        model.load_state_dict(state['model'])
+        optim.load_state_dict(state['optim'])
+        train_loss, valid_loss, test_loss, test_rouge = state['history']
+        start_epoch = state['epoch']
+        start_step = state['step']
+        all_loss = state['all_loss']
+        if torch.is_tensor(all_loss):
+            # saved from the device the losses accumulate on, loaded on cpu
+            all_loss = all_loss.to(next(model.parameters()).device)
+        num = state['num']
+        rng = state['rng']
+
+    def train_state(epoch, step):
+        return {
+            'model': model.state_dict(),
+            'optim': optim.state_dict(),
+            'epoch': epoch,
+            'step': step,
+            'all_loss': all_loss,
+            'num': num,
+            'history': (train_loss, valid_loss, test_loss, test_rouge),
+            'rng': get_rng_state(),
+        }
+
+    for e in range(start_epoch, args.epoch):
         model.train()
-        all_loss = 0
-        num = 0
-        for step, batch in enumerate(train_loader):
+        train_loader.sampler.set_epoch(e, start_step * config.batch_size)
+        # iter draws the loader seed from the global rng: states of step 0 are saved
+        # before that draw, states saved mid-epoch after it
+        if rng is not None and start_step == 0:
+            set_rng_state(rng)
+            rng = None
+        batches = iter(train_loader)
+        if rng is not None:
+            set_rng_state(rng)
+            rng = None
+        if monitor is not None:
+            monitor.resume()
+        for step, batch in enumerate(batches, start_step):
+            if monitor is not None:
+                monitor.step_begin(step)
             num += 1
             x, y = batch
             if torch.cuda.is_available():
                 x = x.cuda()
                 y = y.cuda()
-            loss, result = model(x, y)
-
-            optim.zero_grad()
-            loss.backward()
-            optim.step()
-
-            all_loss += loss.item()
+            with stage('forward'):
+                loss, result = model(x, y)
+
+            with stage('backward'):
+                optim.zero_grad()
+                loss.backward()
+            with stage('optim'):
+                optim.step()
+
+            # accumulate on device, no host sync per step
+            all_loss += loss.detach()
+            if monitor is not None:
+                monitor.step_end(e, step, x, y, loss)
             if step % 200 == 0:
                 print('epoch:', e, '|step:', step, '|train_loss: %.4f' % loss.item())
+            if config.save_every and (step + 1) % config.save_every == 0:
+                writer.save_state(train_state(e, step + 1), e, step + 1)
+                if monitor is not None:
+                    monitor.resume()
 
         # train loss
-        loss = all_loss / num
+        loss = float(all_loss) / num
         print('epoch:', e, '|train_loss: %.4f' % loss)
         train_loss.append(loss)
+        start_step = 0
+        all_loss = 0
+        num = 0
 
-        # valid
-        loss_v = valid(model, e, config.filename_trimmed_valid, config)
+        # valid, test on the subset, on everything every eval_full_every epochs
+        full = config.eval_full_every > 0 and (e + 1) % config.eval_full_every == 0
+        subset = 0 if full or e == args.epoch - 1 else config.eval_subset
+        filename = config.filename_model + 'model_' + str(e) + '.pkl'
+        if config.eval_background:
+            writer.save(model.state_dict(), filename)
+            writer.wait()
+            if eval_process is not None:
+                eval_process.join()
+            eval_process = multiprocessing.get_context('spawn').Process(
+                target=evaluate_checkpoint, args=(config, idx2word, filename, e, subset))
+            eval_process.start()
+            loss_v, rouge, loss_t = None, None, None
+        else:
+            loss_v, rouge, loss_t = evaluate(model, e, idx2word, config, evaluator, subset)
+            if args.save_model:
+                writer.save(model.state_dict(), filename)
         valid_loss.append(loss_v)
-
-        # test
-        rouge, loss_t = test(model, e, idx2word, config)
         test_loss.append(loss_t)
         test_rouge.append(rouge)
-
-        if args.save_model:
-            filename = config.filename_model + 'model_' + str(e) + '.pkl'
-            save_model(model, filename)
+        writer.save_state(train_state(e + 1, 0), e + 1, 0)
+    writer.close()
+    evaluator.close()
+    if eval_process is not None:
+        eval_process.join()
+    if monitor is not None:
+        monitor.close()
+    if profiler is not None:
+        profiler.detach()
+        profiler.report()
 
     # # write result
     # save_plot(test_loss, valid_loss, test_loss, test_rouge, config.filename_data)
@@ -150,6 +253,19 @@ if __name__ == '__main__':
     parser.add_argument('-seed', '-s', type=int, default=123, help="Random seed")
     parser.add_argument('--save_model', '-m', action='store_true', default=False, help="whether to save model")
     parser.add_argument('--checkpoint', '-c', type=int, default=0, help="load model")
+    parser.add_argument('--resume', action='store_true', default=False, help="resume from the latest training state")
+    parser.add_argument('--save_every', type=int, default=0, help="save training state every n steps, 0: every epoch")
+    parser.add_argument('--monitor', type=str, default='', help="write instrumentation JSON lines to this file")
+    parser.add_argument('--profile', type=int, nargs=2, default=None, metavar=('START', 'END'),
+                        help="capture a torch.profiler trace of steps [START, END)")
+    parser.add_argument('--module_profile', action='store_true', default=False,
+                        help="time attention, cnn, rnn and output modules and print a table at the end")
+    parser.add_argument('--eval_subset', type=int, default=None, help="examples evaluated per epoch, 0: all")
+    parser.add_argument('--eval_full_every', type=int, default=None, help="full evaluation every n epochs")
+    parser.add_argument('--eval_background', action='store_true', default=False,
+                        help="evaluate the saved model of each epoch in a separate process")
+    parser.add_argument('--bf16', action='store_true', default=False, help="bfloat16 autocast")
+    parser.add_argument('--segment', type=int, default=0, help="decoder steps per activation checkpoint, 0: off")
     args = parser.parse_args()
 
     ########test##########
@@ -160,6 +276,24 @@ if __name__ == '__main__':
         config.batch_size = args.batch_size
     if args.n_layers:
         config.n_layers = args.n_layers
+    if args.save_every:
+        config.save_every = args.save_every
+    if args.monitor:
+        config.filename_monitor = args.monitor
+    if args.profile:
+        config.profile_steps = args.profile
+    if args.module_profile:
+        config.module_profile = True
+    if args.eval_subset is not None:
+        config.eval_subset = args.eval_subset
+    if args.eval_full_every is not None:
+        config.eval_full_every = args.eval_full_every
+    if args.eval_background:
+        config.eval_background = True
+    if args.bf16:
+        config.bf16 = True
+    if args.segment:
+        config.checkpoint_segment = args.segment
 
     # seed
     torch.manual_seed(args.seed)
@@ -1,3 +1,5 @@
 from utils.config import *
 from utils.data import *
-from utils.dict import *
\ No newline at end of file
+from utils.dict import *
+from utils.monitor import *
+from utils.dedup import *
@@ -10,7 +10,14 @@ class Config():
         self.filename_trimmed_valid = 'DATA/data/valid.pt'
         self.filename_trimmed_test = 'DATA/data/test.pt'
 
-        # bos eos
+        # dedup of the train set, exact and MinHash/LSH near duplicates, and examples overlapping valid/test
+        self.dedup = False
+        self.dedup_workers = 4
+        self.dedup_threshold = 0.8 # shingle Jaccard similarity of near duplicates
+        self.filename_dedup_report = 'DATA/data/dedup.json'
+
+        # pad bos eos
+        self.pad = 0
         self.bos = 2
         self.eos = 3
 
@@ -22,10 +29,11 @@ class Config():
         # sequence length
         self.t_len = 150
         self.s_len = 50
+        self.dynamic_len = False # cut each batch to its longest source and mask the padding
 
         # embedding
         self.filename_embedding = ''
-        self.filename_trimmed_embedding = ''
+        self.filename_trimmed_embedding = '' # .npy written by get_embeddings, '': no pretrained embeddings
 
         # filename
         #################################################
@@ -34,6 +42,26 @@ class Config():
         self.filename_rouge = 'result/data/ROUGE.txt'
         #################################################
         self.filename_gold = 'result/gold/gold_summaries.txt'
+        self.filename_cache = 'result/cache/' # encoder output caches (models.EncoderCache)
+        self.write_summary = True # write summary_<epoch>.txt next to the ROUGE log
+        self.rouge_workers = 4 # 0: score ROUGE in the main process
+        self.pipeline_queue = 4 # batches buffered between loading, decoding and writing
+        self.loader_workers = 2 # DataLoader worker processes, 0: load in the main process
+
+        # evaluation schedule
+        self.eval_subset = 0 # 0: evaluate on all of valid/test every epoch
+                             # k: a fixed, seeded subset of k examples
+        self.eval_full_every = 0 # n: evaluate on everything every n epochs and after the last one
+        self.eval_seed = 123
+        self.eval_background = False # evaluate the saved model in a separate process
+        self.eval_threads = 2 # torch threads of the evaluation process
+
+        # instrumentation
+        self.filename_monitor = '' # '': off, else JSON lines written by utils.Monitor
+        self.monitor_every = 200
+        self.profile_steps = (-1, -1) # [start, end) steps traced by torch.profiler
+        self.filename_trace = 'result/trace/'
+        self.module_profile = False # per-module forward/backward timing (utils.ModuleProfiler)
 
         # Hyper Parameters
         self.LR = 0.0003
@@ -50,6 +78,8 @@ class Config():
         self.bidirectional = True
         self.optimzer = 'Adam'
         self.intra_decoder = False
+        self.bf16 = False # bfloat16 autocast for train, sample and beam_search, weights stay fp32
+        self.parallel_encoder = False # run the rnn encoder and the cnn encoder at the same time
         self.cnn = 2 # cnn=0: no cnn
                      # cnn=1: cat
                      # cnn=2: prob
@@ -57,4 +87,23 @@ class Config():
         self.rl = 2 # 0: ML
                     # 1: RL
                     # 2: ML+RL
-        self.r = 0.99
\ No newline at end of file
+                    # 3: ML+self-critical RL, rl_samples sampled summaries against a greedy one
+        self.rl_samples = 4
+        self.r = 0.99
+
+        # training state checkpoints
+        self.keep_checkpoint = 3 # number of training states kept in filename_model
+        self.save_every = 0 # 0: save training state at the end of each epoch
+                            # n: also every n steps
+
+        # activation checkpointing
+        self.checkpoint_segment = 0 # 0: keep all decoder activations
+                                    # n: recompute every n decoder steps in backward
+
+
+# config saved as a dict of its attributes (json), lists back to tuples where Config has tuples
+def config_from_dict(values):
+    config = Config()
+    for name, value in values.items():
+        setattr(config, name, tuple(value) if isinstance(getattr(config, name, None), tuple) else value)
+    return config
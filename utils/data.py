@@ -1,7 +1,8 @@
+import os
+import hashlib
 import torch
 import torch.utils.data as data_util
 import numpy as np
-from scipy.stats import truncnorm
 
 
 class Datasets():
@@ -77,27 +78,135 @@ def save_data(text, summary, word2idx, t_len, s_len, filename):
     torch.save(data, filename)
 
 
+def embedding_key(filename, word2idx, chunk_size=2**20):
+    """
+    hash of the whole embedding file and the vocab, keys the trimmed embeddings
+    the file is streamed in chunks, never held in memory
+    """
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    h.update(repr(sorted(word2idx.items(), key=lambda x: x[1])).encode('utf-8'))
+    return h.hexdigest()
+
+
 def get_embeddings(config, vocab):
-    embeddings = np.zeros((config.vocab_size, config.embedding_dim))
-    flag = list(np.arange(0, 4000))
-    with open(config.filename_embedding, 'r', encoding='utf-8') as f:
+    """
+    Trimmed embeddings (vocab_size, embedding_dim) float32, saved as .npy at
+    filename_trimmed_embedding, reused while the embedding file and vocab are unchanged.
+    Only the lines of vocab words are decoded and parsed; words missing from
+    the file get truncated normal vectors drawn at once.
+    """
+    from scipy.stats import truncnorm
+    filename = config.filename_trimmed_embedding
+    key = embedding_key(config.filename_embedding, vocab.word2idx)
+    if os.path.isfile(filename) and os.path.isfile(filename + '.key'):
+        with open(filename + '.key', 'r') as f:
+            if f.read() == key:
+                print('embeddings cached at:', filename)
+                return
+
+    word2idx = {w.encode('utf-8'): i for w, i in vocab.word2idx.items() if i < config.vocab_size}
+    rows = []
+    values = []
+    found = set()
+    with open(config.filename_embedding, 'rb') as f:
         for line in f:
-            line = line.strip().split(' ')
-            word = line[0]
-            if word in vocab.word2idx.keys():
-                flag.remove(vocab.word2idx[word])
-                embedding = [float(x) for x in line[1:]]
-                embeddings[vocab.word2idx[word]] = embedding
-    for i in flag:
-        np.random.seed(i)
-        embedding = truncnorm.rvs(-2, 2, size=config.embedding_dim)
-        embeddings[i] = embedding
-    embeddings = torch.from_numpy(embeddings)
-    torch.save(embeddings, config.filename_trimmed_embedding)
-    print('embeddings save at:', config.filename_trimmed_embedding)
-
-
-def data_load(filename, batch_size, shuffle):
+            word, _, rest = line.rstrip().partition(b' ')
+            idx = word2idx.get(word)
+            if idx is None or idx in found:
+                continue
+            # a word2vec header or a broken line has the wrong number of fields
+            if rest.count(b' ') + 1 != config.embedding_dim:
+                continue
+            found.add(idx)
+            rows.append(idx)
+            values.append(rest)
+
+    embeddings = np.empty((config.vocab_size, config.embedding_dim), dtype=np.float32)
+    if rows:
+        parsed = np.fromstring(b' '.join(values).decode('ascii'), dtype=np.float32, sep=' ')
+        embeddings[rows] = parsed.reshape(len(rows), config.embedding_dim)
+    missing = np.setdiff1d(np.arange(config.vocab_size), np.array(rows, dtype=np.int64))
+    embeddings[missing] = truncnorm.rvs(-2, 2, size=(len(missing), config.embedding_dim),
+                                        random_state=np.random.RandomState(0))
+
+    tmp = filename + '.tmp.npy'
+    np.save(tmp, embeddings)
+    os.replace(tmp, filename)
+    with open(filename + '.key', 'w') as f:
+        f.write(key)
+    print('embeddings save at:', filename, '|found: %d' % len(rows), '|random: %d' % len(missing))
+
+
+# trimmed embeddings as a copy-on-write memory map, pages are read when used
+def load_embeddings(filename):
+    return torch.from_numpy(np.load(filename, mmap_mode='c'))
+
+
+class EpochSampler(data_util.Sampler):
+    """
+    Order of an epoch is fixed by (seed, epoch), so a resumed run sees the same
+    batches. The first `skip` examples of the epoch are left out.
+    """
+    def __init__(self, n, shuffle, seed):
+        self.n = n
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.skip = 0
+
+    def set_epoch(self, epoch, skip=0):
+        self.epoch = epoch
+        self.skip = skip
+
+    def __iter__(self):
+        if self.shuffle:
+            g = torch.Generator()
+            g.manual_seed(self.seed + self.epoch)
+            order = torch.randperm(self.n, generator=g).tolist()
+        else:
+            order = list(range(self.n))
+        return iter(order[self.skip:])
+
+    def __len__(self):
+        return self.n - self.skip
+
+
+# train loader whose position can be saved and restored through loader.sampler
+def train_load(filename, batch_size, seed, num_workers=2):
     data = torch.load(filename)
-    data_loader = data_util.DataLoader(data, batch_size, shuffle=shuffle, num_workers=2)
-    return data_loader
\ No newline at end of file
+    sampler = EpochSampler(len(data), True, seed)
+    data_loader = data_util.DataLoader(data, batch_size, sampler=sampler, num_workers=num_workers)
+    return data_loader
+
+
+# fixed, seeded subset of k out of n examples, in dataset order
+def subset_index(n, k, seed):
+    if k <= 0 or k >= n:
+        return None
+    index = np.random.RandomState(seed).choice(n, k, replace=False)
+    return np.sort(index).tolist()
+
+
+# subset > 0 loads only a fixed, seeded subset of the examples (loader.dataset.indices)
+def data_load(filename, batch_size, shuffle, subset=0, seed=0, num_workers=2):
+    data = torch.load(filename)
+    index = subset_index(len(data), subset, seed)
+    if index is not None:
+        data = data_util.Subset(data, index)
+    data_loader = data_util.DataLoader(data, batch_size, shuffle=shuffle, num_workers=num_workers)
+    return data_loader
+
+
+# synthetic LCSTS shaped inputs for benchmarks and reports, no dataset files needed
+def synthetic_idx2word(config):
+    return ['<pad>', '<unk>', '<bos>', '<eos>'] + [chr(0x4e00 + i) for i in range(config.vocab_size - 4)]
+
+
+def synthetic_batch(config, batch_size=None):
+    batch_size = batch_size or config.batch_size
+    x = torch.randint(4, config.vocab_size, (batch_size, config.t_len))
+    y = torch.randint(4, config.vocab_size, (batch_size, config.s_len))
+    return x, y
@@ -0,0 +1,201 @@
+import zlib
+import hashlib
+import multiprocessing
+import numpy as np
+
+
+# Mersenne prime of the MinHash permutations, shingle hashes are 32 bit crc32
+_prime = np.uint64((1 << 31) - 1)
+
+
+def normalize(text):
+    return ''.join(text.split()).lower()
+
+
+def shingles(text, n):
+    if len(text) <= n:
+        return {text}
+    return {text[i:i+n] for i in range(len(text) - n + 1)}
+
+
+def jaccard(a, b, n):
+    a = shingles(normalize(a), n)
+    b = shingles(normalize(b), n)
+    return len(a & b) / max(len(a | b), 1)
+
+
+# permutations of the worker process, sent once by the pool initializer
+_params = None
+
+
+def _init_worker(params):
+    global _params
+    _params = params
+
+
+def text_keys(text, params):
+    """
+    :return: exact hash of the normalized text, (bands,) LSH keys of its MinHash signature
+    """
+    n, a, b, mult = params
+    text = normalize(text)
+    exact = int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'little')
+    h = np.fromiter((zlib.crc32(s.encode('utf-8')) for s in shingles(text, n)), dtype=np.uint64)
+    # (num_perm,) min over the shingles of (a*h + b) mod p
+    signature = ((a[:, None] * (h[None, :] % _prime) + b[:, None]) % _prime).min(axis=1)
+    # one key per band of rows, uint64 arithmetic wraps
+    keys = (signature.reshape(mult.shape[0], -1) * mult).sum(axis=1)
+    return exact, keys
+
+
+def _shard_keys(shard):
+    start, texts = shard
+    exact = np.zeros(len(texts), dtype=np.uint64)
+    keys = np.zeros((len(texts), _params[3].shape[0]), dtype=np.uint64)
+    for i, text in enumerate(texts):
+        exact[i], keys[i] = text_keys(text, _params)
+    return start, exact, keys
+
+
+def shared(column):
+    """
+    :param column: (n,) keys
+    :return: (n,) bool, examples whose key is shared with another example
+    """
+    _, inverse, counts = np.unique(column, return_inverse=True, return_counts=True)
+    return counts[inverse] > 1
+
+
+class Deduplicator():
+    """
+    Exact and near-duplicate detection on character shingles of the source texts.
+    Exact duplicates share the 64 bit hash of the normalized text. Near duplicates
+    share a band of their MinHash signature (LSH) and are then checked with the
+    exact shingle Jaccard similarity. Workers hash shards of the texts and return
+    only the keys, bands*8 bytes per example; the signatures never leave them.
+    """
+    def __init__(self, n_workers=4, shingle=5, num_perm=64, bands=16, threshold=0.8,
+                 shard_size=10000, seed=123):
+        if num_perm % bands:
+            raise ValueError('num_perm must be a multiple of bands')
+        rng = np.random.RandomState(seed)
+        a = rng.randint(1, int(_prime), num_perm).astype(np.uint64)
+        b = rng.randint(0, int(_prime), num_perm).astype(np.uint64)
+        mult = (rng.randint(1, 1 << 62, (bands, num_perm // bands), dtype=np.int64) | 1).astype(np.uint64)
+        self.params = (shingle, a, b, mult)
+        self.shingle = shingle
+        self.bands = bands
+        self.threshold = threshold
+        self.shard_size = shard_size
+        self.pool = None
+        if n_workers > 0:
+            self.pool = multiprocessing.Pool(n_workers, _init_worker, (self.params,))
+
+    def keys(self, texts):
+        """
+        :return: exact (n,) uint64, keys (n, bands) uint64
+        """
+        exact = np.zeros(len(texts), dtype=np.uint64)
+        keys = np.zeros((len(texts), self.bands), dtype=np.uint64)
+        shards = ((i, texts[i:i+self.shard_size]) for i in range(0, len(texts), self.shard_size))
+        if self.pool is None:
+            _init_worker(self.params)
+            results = map(_shard_keys, shards)
+        else:
+            results = self.pool.imap_unordered(_shard_keys, shards)
+        for start, e, k in results:
+            exact[start:start+len(e)] = e
+            keys[start:start+len(e)] = k
+        return exact, keys
+
+    def duplicates(self, texts):
+        """
+        :return: exact (n,) bool, near (n,) bool, every example but the first of a group is marked
+        """
+        exact_hash, keys = self.keys(texts)
+        _, first = np.unique(exact_hash, return_index=True)
+        exact = np.ones(len(texts), dtype=bool)
+        exact[first] = False
+
+        # in dataset order, each example is compared with the kept examples of its
+        # band buckets, so a removed example always has a kept near duplicate
+        near = np.zeros(len(texts), dtype=bool)
+        candidates = np.zeros(len(texts), dtype=bool)
+        for band in range(self.bands):
+            candidates |= shared(keys[:, band])
+        kept = [{} for _ in range(self.bands)]
+        for i in np.nonzero(candidates & ~exact)[0]:
+            row = keys[i].tolist()
+            seen = set()
+            for band, k in enumerate(row):
+                for j in kept[band].get(k, ()):
+                    if j in seen:
+                        continue
+                    seen.add(j)
+                    if jaccard(texts[i], texts[j], self.shingle) >= self.threshold:
+                        near[i] = True
+                        break
+                if near[i]:
+                    break
+            if not near[i]:
+                for band, k in enumerate(row):
+                    kept[band].setdefault(k, []).append(i)
+        return exact, near
+
+    def overlap(self, texts, references):
+        """
+        :return: (n,) bool, texts that duplicate or nearly duplicate one of the references
+        """
+        exact_hash, keys = self.keys(texts)
+        ref_hash, ref_keys = self.keys(references)
+        found = np.isin(exact_hash, ref_hash)
+        checked = set()
+        for band in range(self.bands):
+            # every reference of a key, several of them can share a band
+            index = {}
+            for j, k in enumerate(ref_keys[:, band].tolist()):
+                index.setdefault(k, []).append(j)
+            for i in np.nonzero(np.isin(keys[:, band], ref_keys[:, band]) & ~found)[0]:
+                for j in index[int(keys[i, band])]:
+                    if (i, j) in checked:
+                        continue
+                    checked.add((i, j))
+                    if jaccard(texts[i], references[j], self.shingle) >= self.threshold:
+                        found[i] = True
+                        break
+        return found
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+
+def dedup_report(text, summary, exact, near, overlap, batch_size, step_ms=0):
+    """
+    :param exact, near, overlap: (n,) bool removed examples
+    :param step_ms: measured train step time, 0: epoch time in steps only
+    """
+    removed = exact | near | overlap
+    n = len(text)
+    kept = n - int(removed.sum())
+    chars = sum(len(t) + len(s) for t, s in zip(text, summary))
+    chars_removed = sum(len(text[i]) + len(summary[i]) for i in np.nonzero(removed)[0])
+    steps = -(-n // batch_size)
+    steps_kept = -(-kept // batch_size)
+    report = {
+        'examples': n,
+        'exact_duplicates': int(exact.sum()),
+        'near_duplicates': int((near & ~exact).sum()),
+        'eval_overlap': int((overlap & ~exact & ~near).sum()),
+        'kept': kept,
+        'removed_fraction': 1 - kept / max(n, 1),
+        'chars_removed_fraction': chars_removed / max(chars, 1),
+        'epoch_steps': steps,
+        'epoch_steps_kept': steps_kept,
+        'epoch_time_saved_fraction': 1 - steps_kept / max(steps, 1),
+    }
+    if step_ms:
+        report['epoch_time_saved_s'] = (steps - steps_kept) * step_ms / 1000
+    return report
@@ -1,5 +1,7 @@
 import pickle
 import os
+import numpy as np
+import torch
 
 
 class Vocab():
@@ -20,6 +22,17 @@ class Vocab():
             self.idx2word = self.load_vocab(self.filename_idx2word)
             self.word2idx = self.load_vocab(self.filename_word2idx)
 
+    # vocab of an inference bundle, nothing is read from disk
+    @classmethod
+    def from_idx2word(cls, config, idx2word):
+        vocab = cls.__new__(cls)
+        vocab.filename_idx2word = config.filename_idx2word
+        vocab.filename_word2idx = config.filename_word2idx
+        vocab.vocab_size = config.vocab_size
+        vocab.idx2word = list(idx2word)
+        vocab.word2idx = {w: i for i, w in enumerate(vocab.idx2word)}
+        return vocab
+
     # check whether the given 'filename' exists
     # raise a FileNotFoundError when file not found
     def file_check(self, filename):
@@ -67,8 +80,8 @@ class Vocab():
     def load_vocab(self, filename):
         print('load vocab from', filename)
         self.file_check(filename)
-        f = open(filename, 'rb')
-        return pickle.load(f)
+        with open(filename, 'rb') as f:
+            return pickle.load(f)
 
 
 # convert idx to words, if idx <bos> is stop, return sentence
@@ -83,4 +96,53 @@ def index2sentence(index, idx2word):
             sen.append(idx2word[index[i]])
     if len(sen) == 0:
         sen.append('<unk>')
-    return sen
\ No newline at end of file
+    return sen
+
+
+class Detokenizer():
+    """
+    index2sentence for a whole (batch, len) id array.
+    The <eos> position is found with one vectorized search, <bos> is dropped
+    with a mask and words come from a numpy object-array lookup.
+    """
+    def __init__(self, idx2word):
+        self.words = np.array(idx2word, dtype=object)
+        self.is_eos = self.words == '<eos>'
+        self.is_bos = self.words == '<bos>'
+        self.eos = int(np.flatnonzero(self.is_eos)[0])
+
+    def _array(self, index):
+        if torch.is_tensor(index):
+            return index.cpu().numpy()
+        if isinstance(index, np.ndarray):
+            return index
+        # ragged rows (beam search) are padded with <eos>
+        rows = [np.asarray(row) for row in index]
+        length = max([len(row) for row in rows] + [1])
+        array = np.full((len(rows), length), self.eos, dtype=np.int64)
+        for i, row in enumerate(rows):
+            array[i, :len(row)] = row
+        return array
+
+    def __call__(self, index):
+        """
+        :param index: (batch, len) ids, array, tensor or list of rows
+        :return: list of word lists, as index2sentence returns them
+        """
+        index = self._array(index)
+        if index.shape[0] == 0:
+            return []
+        eos = self.is_eos[index]
+        stop = np.where(eos.any(axis=1), eos.argmax(axis=1), index.shape[1])
+        keep = (np.arange(index.shape[1]) < stop[:, None]) & ~self.is_bos[index]
+        tokens = self.words[index]
+        sentences = []
+        for i in range(index.shape[0]):
+            sen = tokens[i][keep[i]].tolist()
+            if len(sen) == 0:
+                sen.append('<unk>')
+            sentences.append(sen)
+        return sentences
+
+    def join(self, index):
+        return [' '.join(sen) for sen in self(index)]
@@ -0,0 +1,326 @@
+import os
+import json
+import time
+import resource
+import contextlib
+import numpy as np
+import torch
+
+
+# the active Monitor, None when instrumentation is off
+_monitor = None
+_null = contextlib.nullcontext()
+# true while activation checkpointing recomputes a segment in backward
+_recomputing = False
+
+
+def stage(name):
+    """
+    time a block of the hot path under `name`
+    costs one global lookup when no Monitor is active
+    """
+    if _monitor is None:
+        return _null
+    return _monitor.stage(name)
+
+
+@contextlib.contextmanager
+def recompute():
+    global _recomputing
+    _recomputing = True
+    try:
+        yield
+    finally:
+        _recomputing = False
+
+
+def checkpoint_contexts():
+    """
+    context_fn of torch.utils.checkpoint, marks the recompute pass
+    so that profiling hooks do not count a module twice
+    """
+    return contextlib.nullcontext(), recompute()
+
+
+def rss_mb():
+    with open('/proc/self/statm') as f:
+        pages = int(f.read().split()[1])
+    return pages * os.sysconf('SC_PAGE_SIZE') / 2**20
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+def parameter_mb(model):
+    return sum(p.numel() * p.element_size() for p in model.parameters()) / 2 ** 20
+
+
+def stats(times):
+    times = np.array(times) * 1000
+    return {
+        'n': len(times),
+        'mean_ms': float(times.mean()),
+        'min_ms': float(times.min()),
+        'p50_ms': float(np.percentile(times, 50)),
+        'p90_ms': float(np.percentile(times, 90)),
+        'p99_ms': float(np.percentile(times, 99)),
+    }
+
+
+def timeit(fn, repeat, warmup):
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return stats(times)
+
+
+def tensor_mb():
+    # cuda allocator, None on cpu where tensors are part of rss_mb
+    if torch.cuda.is_available():
+        return torch.cuda.memory_allocated() / 2**20
+    return None
+
+
+class Monitor():
+    """
+    Opt-in training instrumentation, written as JSON lines.
+    Every `every` steps one record with mean stage times (ms), examples/s,
+    tokens/s (padded), loss and memory of the window is emitted.
+    Steps [profile_start, profile_end) are captured with torch.profiler
+    and exported as a chrome trace to trace_dir.
+    """
+    def __init__(self, filename, every=200, profile_start=-1, profile_end=-1, trace_dir='result/trace/'):
+        self.filename = filename
+        self.every = every
+        self.profile_start = profile_start
+        self.profile_end = profile_end
+        self.trace_dir = trace_dir
+        self.sync = torch.cuda.is_available()
+        self.f = open(filename, 'a', encoding='utf-8')
+        self.profiler = None
+        self._reset()
+        self.last = time.perf_counter()
+
+    def _reset(self):
+        self.stages = {}
+        self.steps = 0
+        self.examples = 0
+        self.tokens = 0
+        self.loss = 0
+        self.start = time.perf_counter()
+
+    def enable(self):
+        global _monitor
+        _monitor = self
+        return self
+
+    def close(self):
+        global _monitor
+        if self.profiler is not None:
+            self._stop_profiler()
+        if _monitor is self:
+            _monitor = None
+        self.f.close()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if self.sync:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.sync:
+                torch.cuda.synchronize()
+            self.stages[name] = self.stages.get(name, 0) + time.perf_counter() - start
+
+    def emit(self, record):
+        self.f.write(json.dumps(record) + '\n')
+        self.f.flush()
+
+    # called at the start of an epoch and after eval / checkpointing, the time since
+    # the last step is neither data loading nor part of the throughput window
+    def resume(self):
+        now = time.perf_counter()
+        self.start += now - self.last
+        self.last = now
+
+    # called when a batch arrives, the time since the last step is data loading
+    def step_begin(self, step):
+        now = time.perf_counter()
+        self.stages['data'] = self.stages.get('data', 0) + now - self.last
+        if step == self.profile_start:
+            self._start_profiler()
+
+    def step_end(self, epoch, step, x, y, loss):
+        """
+        :param x: (batch, t_len)
+        :param y: (batch, s_len)
+        :param loss: loss tensor of the step, kept on device until the window is emitted
+        """
+        self.steps += 1
+        self.examples += x.size(0)
+        self.tokens += x.numel() + y.numel()
+        self.loss = self.loss + loss.detach()
+        if self.profiler is not None and step + 1 >= self.profile_end:
+            self._stop_profiler()
+        if self.steps == self.every:
+            self._flush(epoch, step)
+        self.last = time.perf_counter()
+
+    def _flush(self, epoch, step):
+        elapsed = time.perf_counter() - self.start
+        self.emit({
+            'event': 'train',
+            'time': time.time(),
+            'epoch': epoch,
+            'step': step,
+            'steps': self.steps,
+            'loss': float(self.loss) / self.steps,
+            'stages_ms': {k: 1000 * v / self.steps for k, v in self.stages.items()},
+            'examples_per_sec': self.examples / elapsed,
+            'tokens_per_sec': self.tokens / elapsed,
+            'rss_mb': rss_mb(),
+            'peak_rss_mb': peak_rss_mb(),
+            'tensor_mb': tensor_mb(),
+        })
+        self._reset()
+
+    def _start_profiler(self):
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.profiler = torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True)
+        self.profiler.__enter__()
+
+    def _stop_profiler(self):
+        self.profiler.__exit__(None, None, None)
+        os.makedirs(self.trace_dir, exist_ok=True)
+        filename = os.path.join(self.trace_dir, 'trace_%d_%d.json' % (self.profile_start, self.profile_end))
+        self.profiler.export_chrome_trace(filename)
+        self.profiler = None
+        self.emit({'event': 'trace', 'time': time.time(), 'filename': filename})
+
+
+def tensor_bytes(out):
+    if torch.is_tensor(out):
+        return out.numel() * out.element_size()
+    if isinstance(out, (list, tuple)):
+        return sum(tensor_bytes(o) for o in out)
+    return 0
+
+
+# modules timed by default: attention, cnn encoders, rnn cells and the output projection
+PROFILE_TYPES = ('Luong_Attention', 'Bahdanau_Attention', 'Encoder_pos', 'Encoder_cnn', 'LSTM', 'GRU')
+PROFILE_NAMES = ('linear_out',)
+
+
+class ModuleProfiler():
+    """
+    Forward/backward timing hooks on the modules of a model.
+    Hooks exist only between attach() and detach(), a detached profiler costs nothing.
+    Backward time is measured between the module's backward pre hook and backward
+    hook, so it is approximate when autograd interleaves other nodes, and missing
+    for modules none of whose inputs require grad (e.g. the embedding fed rnn of the
+    encoder with frozen embeddings). Forward passes recomputed by activation
+    checkpointing are not counted.
+    """
+    def __init__(self, model, names=None):
+        self.model = model
+        self.modules = {}
+        for name, module in model.named_modules():
+            if names is not None:
+                if name in names:
+                    self.modules[name] = module
+            elif type(module).__name__ in PROFILE_TYPES or name in PROFILE_NAMES:
+                self.modules[name] = module
+        self.handles = []
+        self.sync = torch.cuda.is_available()
+        self.reset()
+
+    def reset(self):
+        self.stats = {name: {'calls': 0, 'forward': 0.0, 'backward': 0.0, 'bytes': 0} for name in self.modules}
+        self.starts = {name: [] for name in self.modules}
+        # a module whose inputs need no grad (e.g. token ids) never gets its backward hook called
+        self.backward_starts = {name: None for name in self.modules}
+
+    def _now(self):
+        if self.sync:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def _hooks(self, name):
+        stats = self.stats
+        starts = self.starts
+        backward_starts = self.backward_starts
+
+        def pre(module, inputs):
+            if _recomputing:
+                return
+            starts[name].append(self._now())
+
+        def post(module, inputs, output):
+            if _recomputing:
+                return
+            stats[name]['forward'] += self._now() - starts[name].pop()
+            stats[name]['calls'] += 1
+            stats[name]['bytes'] += tensor_bytes(output)
+
+        def backward_pre(module, grad_output):
+            backward_starts[name] = self._now()
+
+        def backward_post(module, grad_input, grad_output):
+            if backward_starts[name] is not None:
+                stats[name]['backward'] += self._now() - backward_starts[name]
+                backward_starts[name] = None
+
+        return pre, post, backward_pre, backward_post
+
+    def attach(self):
+        for name, module in self.modules.items():
+            pre, post, backward_pre, backward_post = self._hooks(name)
+            self.handles.append(module.register_forward_pre_hook(pre))
+            self.handles.append(module.register_forward_hook(post))
+            self.handles.append(module.register_full_backward_pre_hook(backward_pre))
+            self.handles.append(module.register_full_backward_hook(backward_post))
+        return self
+
+    def detach(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+    def table(self):
+        rows = []
+        for name, s in self.stats.items():
+            if s['calls'] == 0:
+                continue
+            rows.append({
+                'module': name,
+                'type': type(self.modules[name]).__name__,
+                'calls': s['calls'],
+                'forward_ms': 1000 * s['forward'],
+                'mean_ms': 1000 * s['forward'] / s['calls'],
+                'backward_ms': 1000 * s['backward'],
+                'output_mb': s['bytes'] / 2**20,
+            })
+        rows.sort(key=lambda r: r['forward_ms'] + r['backward_ms'], reverse=True)
+        return rows
+
+    def report(self):
+        rows = self.table()
+        print('%-32s %-18s %8s %12s %10s %12s %10s' % ('module', 'type', 'calls', 'forward ms', 'mean ms',
+                                                     'backward ms', 'out MB'))
+        for r in rows:
+            print('%-32s %-18s %8d %12.1f %10.3f %12.1f %10.1f' % (r['module'], r['type'], r['calls'],
+                                                                r['forward_ms'], r['mean_ms'],
+                                                                r['backward_ms'], r['output_mb']))
+        print('backward ms is 0 for modules whose inputs need no grad, '
+              'forward passes recomputed by activation checkpointing are not counted')
+        return rows